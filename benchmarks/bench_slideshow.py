@@ -0,0 +1,218 @@
+"""Benchmarks the slideshow engine against a local fake Danbooru server.
+
+The server runs in a child process so its threads do not count towards the engine's CPU
+wakeups or memory. Results are written as JSON so runs can be compared between revisions:
+
+    python benchmarks/bench_slideshow.py --wallpapers 20 --latency-ms 100 --output before.json
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import psutil
+from fake_danbooru import add_server_arguments, server_from_args
+from wallpaper_engine import (
+    FileSinkBackend, HttpClient, ImageCache, MonitorLayout, ShownHistory, SlideshowEngine, load_snapshot, metrics,
+)
+
+
+def serve(args, connection):
+    """Child process: runs the fake server and reports its base URL back."""
+    server = server_from_args(args)
+    connection.send(server.base_url)
+    server.serve_forever()
+
+def percentile(values, p):
+    """Nearest-rank percentile of values, or None if there are none."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(p / 100 * len(ordered)) - 1))]
+
+def peak_rss_bytes(process):
+    """Peak resident memory of this process so far."""
+    memory = process.memory_info()
+    if hasattr(memory, 'peak_wset'): # Windows
+        return memory.peak_wset
+    import resource
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+def voluntary_switches(process):
+    """Context switches where a thread of this process gave up the CPU, i.e. went to sleep and later woke up."""
+    if sys.platform.startswith('linux'):
+        # /proc/<pid>/status only covers the main thread, so add up every thread's own counter.
+        total = 0
+        for task in os.listdir(f"/proc/{process.pid}/task"):
+            try:
+                with open(f"/proc/{process.pid}/task/{task}/status") as f:
+                    total += sum(int(line.split()[1]) for line in f if line.startswith('voluntary_ctxt_switches'))
+            except OSError:
+                pass # The thread exited while we were looking
+        return total
+    return process.num_ctx_switches().voluntary
+
+def server_stats(base_url):
+    with urllib.request.urlopen(f"{base_url}/_bench/stats") as response:
+        return json.load(response)
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def wait_for(condition, timeout):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.05)
+    return True
+
+def run_active(args, base_url, work_dir, process):
+    """Cold start: measures time to the first wallpaper and the latency of every change after it."""
+    sink = FileSinkBackend(os.path.join(work_dir, 'active.jpg'))
+    http_client = HttpClient(base_url=base_url)
+    engine = SlideshowEngine(backend=sink, http_client=http_client, image_cache=ImageCache(os.path.join(work_dir, 'cache')),
+                             history=ShownHistory(os.path.join(work_dir, 'history.bin')),
+                             snapshot_path=os.path.join(work_dir, 'snapshot.json'), on_status=None)
+    layout = MonitorLayout.parse(args.monitors)
+    stats_before = server_stats(base_url)
+    metrics.reset()
+    switches_before = voluntary_switches(process)
+    started_at = time.monotonic()
+    engine.start(args.tags, args.rating, args.interval, layout, crop=args.crop)
+    finished = wait_for(lambda: len(sink.history) >= args.wallpapers, args.timeout)
+    elapsed = time.monotonic() - started_at
+    switches = voluntary_switches(process) - switches_before
+    engine.stop(timeout=5)
+    stats = server_stats(base_url)
+
+    # Change latency is the time from a change falling due to the wallpaper being applied; the first change is
+    # reported separately as the time to first wallpaper.
+    waits, sets = metrics.samples('queue_wait'), metrics.samples('set_wallpaper')
+    latencies = [(wait + set_time) * 1000 for wait, set_time in zip(waits[1:], sets[1:])]
+    wallpapers = len(sink.history)
+    api_requests = stats['api_requests'] - stats_before['api_requests']
+    counters = metrics.snapshot()['counters']
+    pages = len(metrics.samples('list_fetch'))
+    usable = counters.get('posts_listed', 0) - counters.get('posts_filtered_out', 0)
+    bytes_sent = stats['bytes_sent'] - stats_before['bytes_sent']
+    return {
+        'completed': finished,
+        'wallpapers': wallpapers,
+        'elapsed_seconds': round(elapsed, 3),
+        'time_to_first_wallpaper_ms': round((sink.history[0][0] - started_at) * 1000, 1) if wallpapers else None,
+        'change_latency_ms': {
+            'p50': round(percentile(latencies, 50), 1) if latencies else None,
+            'p99': round(percentile(latencies, 99), 1) if latencies else None,
+            'max': round(max(latencies), 1) if latencies else None,
+        },
+        'api_requests': api_requests,
+        'api_requests_per_wallpaper': round(api_requests / wallpapers, 3) if wallpapers else None,
+        'image_requests': stats['image_requests'] - stats_before['image_requests'],
+        'bytes_per_wallpaper': round(bytes_sent / wallpapers) if wallpapers else None,
+        'usable_posts_per_page': round(usable / pages, 1) if pages else None,
+        'server': {name: stats[name] - stats_before[name] for name in stats},
+        'client': http_client.get_stats(),
+        'wakeups_per_hour': round(switches / elapsed * 3600),
+        'metrics': metrics.snapshot(),
+    }
+
+def run_warm(args, base_url, work_dir):
+    """Warm start: a fresh engine resumes from the snapshot the active run saved on stop, as --startup does."""
+    snapshot_path = os.path.join(work_dir, 'snapshot.json')
+    load_started = time.perf_counter()
+    snapshot = load_snapshot(snapshot_path)
+    load_ms = (time.perf_counter() - load_started) * 1000
+    sink = FileSinkBackend(os.path.join(work_dir, 'warm.jpg'))
+    engine = SlideshowEngine(backend=sink, http_client=HttpClient(base_url=base_url), image_cache=ImageCache(os.path.join(work_dir, 'cache')),
+                             history=ShownHistory(os.path.join(work_dir, 'history.bin')), snapshot_path=snapshot_path, on_status=None)
+    stats_before = server_stats(base_url)
+    metrics.reset()
+    started_at = time.monotonic()
+    engine.start(args.tags, args.rating, args.interval, MonitorLayout.parse(args.monitors), crop=args.crop, snapshot=snapshot)
+    finished = wait_for(lambda: sink.history, args.timeout)
+    first_at = sink.history[0][0] if finished else None
+    engine.stop(timeout=5)
+    stats = server_stats(base_url)
+    return {
+        'completed': bool(finished),
+        'snapshot_bytes': os.path.getsize(snapshot_path) if snapshot else None,
+        'snapshot_load_ms': round(load_ms, 2),
+        'restored_wallpapers': metrics.snapshot()['counters'].get('snapshot_restored', 0),
+        'time_to_first_wallpaper_ms': round((first_at - started_at) * 1000, 1) if first_at else None,
+        'api_requests': stats['api_requests'] - stats_before['api_requests'],
+    }
+
+def run_idle(args, base_url, work_dir, process):
+    """Steady state: once the first wallpaper is up and the queue is full, counts how often the engine wakes up."""
+    sink = FileSinkBackend(os.path.join(work_dir, 'idle.jpg'))
+    engine = SlideshowEngine(backend=sink, http_client=HttpClient(base_url=base_url), image_cache=ImageCache(os.path.join(work_dir, 'cache')),
+                             history=ShownHistory(os.path.join(work_dir, 'history.bin')),
+                             snapshot_path=os.path.join(work_dir, 'snapshot.json'), on_status=None)
+    engine.start(args.tags, args.rating, 24 * 60 * 60, MonitorLayout.parse(args.monitors), crop=args.crop)
+    ready = wait_for(lambda: sink.history and engine.prefetcher.depth() >= engine.prefetcher.queue_size, args.timeout)
+    switches_before = voluntary_switches(process)
+    time.sleep(args.idle_seconds)
+    switches = voluntary_switches(process) - switches_before
+    engine.stop(timeout=5)
+    return {
+        'completed': ready,
+        'seconds': args.idle_seconds,
+        'wakeups_per_hour': round(switches / args.idle_seconds * 3600),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--wallpapers', type=int, default=10, help="Wallpaper changes to measure.")
+    parser.add_argument('--interval', type=int, default=1, help="Slideshow interval in seconds.")
+    parser.add_argument('--idle-seconds', type=float, default=10, help="How long to count wakeups while idle; 0 skips it.")
+    parser.add_argument('--timeout', type=float, default=300, help="Give up on a phase after this many seconds.")
+    parser.add_argument('--tags', default="1girl solo")
+    parser.add_argument('--rating', default="general")
+    parser.add_argument('--monitors', default="1920x1080")
+    parser.add_argument('--crop', action='store_true', help="Run the slideshow in crop-to-fit mode.")
+    parser.add_argument('--output', help="Write the JSON results here instead of stdout.")
+    add_server_arguments(parser)
+    args = parser.parse_args()
+
+    parent_connection, child_connection = multiprocessing.Pipe()
+    server_process = multiprocessing.Process(target=serve, args=(args, child_connection), daemon=True)
+    server_process.start()
+    base_url = parent_connection.recv()
+    process = psutil.Process()
+    try:
+        with tempfile.TemporaryDirectory() as work_dir:
+            results = {
+                'revision': git_revision(),
+                'timestamp': time.strftime("%Y-%m-%dT%H:%M:%S"),
+                'platform': sys.platform,
+                'config': vars(args),
+                'active': run_active(args, base_url, work_dir, process),
+            }
+            results['warm'] = run_warm(args, base_url, work_dir)
+            if args.idle_seconds > 0:
+                results['idle'] = run_idle(args, base_url, work_dir, process)
+            results['peak_rss_mb'] = round(peak_rss_bytes(process) / (1024 * 1024), 1)
+    finally:
+        server_process.terminate()
+
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    print(text)
+
+if __name__ == "__main__":
+    main()
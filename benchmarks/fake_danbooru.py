@@ -0,0 +1,302 @@
+"""A local stand-in for the parts of the Danbooru API the slideshow uses, for benchmarks and offline testing.
+
+Serves /counts/posts.json, /posts.json, /posts/<id>.json and the image files they point to, with
+configurable page contents, aspect-ratio mix, image sizes, latency, 429 responses and dropped connections.
+JSON responses carry an ETag and answer a matching If-None-Match with 304, and every post lists smaller
+media_asset.variants like Danbooru's. Run it directly to point the app at it by hand:
+
+    python benchmarks/fake_danbooru.py --port 8000 --latency-ms 150 --rate-429 0.05
+    python wallpaper_app.py --base-url http://127.0.0.1:8000
+"""
+import argparse
+import hashlib
+import io
+import json
+import random
+import re
+import threading
+import time
+import zlib
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from PIL import Image
+
+DEFAULT_ASPECT_MIX = "16:9=0.6,16:10=0.1,4:3=0.1,9:16=0.2"
+DEFAULT_WIDTHS = "1920,2560,3840"
+RATIO_TAG_RE = re.compile(r'^ratio:([\d.]+)\.\.([\d.]+)$')
+RESTART_MARKER_RE = re.compile(rb'\xff[\xd0-\xd7]')
+FAKE_TAGS = ["1girl", "solo", "long_hair", "smile", "scenery"] # Reported by /posts/<id>.json, consistent with matching_posts()
+THUMBNAIL_BOX = 180 # Danbooru's smallest variant fits in a 180x180 box
+IMAGE_BANDS = 8 # Horizontal bands per image, each cut from a different part of the render, so posts of one size look different even to a perceptual hash
+
+
+def parse_aspect_mix(text):
+    """Parses "16:9=0.6,4:3=0.4" into [(ratio, weight), ...]."""
+    mix = []
+    for entry in text.split(','):
+        shape, _, weight = entry.strip().partition('=')
+        width, _, height = shape.partition(':')
+        mix.append((float(width) / float(height), float(weight or 1)))
+    return mix
+
+
+class FakeDanbooruServer(ThreadingHTTPServer):
+    """HTTP server holding a deterministic set of fake posts plus counters of what was served."""
+    daemon_threads = True
+
+    def __init__(self, address, posts=2000, aspect_mix=DEFAULT_ASPECT_MIX, widths=DEFAULT_WIDTHS,
+                 latency_ms=0, jitter_ms=0, rate_429=0.0, retry_after=1, drop_rate=0.0, empty_tags="", sample_width=1920, seed=1):
+        super().__init__(address, FakeDanbooruHandler)
+        self.latency = latency_ms / 1000
+        self.jitter = jitter_ms / 1000
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.drop_rate = drop_rate
+        self.empty_tags = set(empty_tags.split(',')) - {''}
+        self.sample_width = sample_width
+        self.random = random.Random(seed)
+        self.images = {} # (width, height) -> (JPEG header, MCU-row segments of the render shared by every post of that size)
+        self.files = {} # post id -> (file size, md5), so listing a page hashes each image only once
+        self.stats = {'api_requests': 0, 'image_requests': 0, 'bytes_sent': 0, 'throttled': 0, 'dropped': 0, 'range_requests': 0,
+                      'variant_requests': 0, 'not_modified': 0}
+        self.lock = threading.Lock()
+        self.generate_lock = threading.Lock() # Held while an image size is first rendered, so every request sees the same bytes
+
+        mix = parse_aspect_mix(aspect_mix)
+        widths = [int(w) for w in widths.split(',')]
+        self.posts = []
+        for post_id in range(1, posts + 1):
+            ratio = self.random.choices([r for r, _ in mix], weights=[w for _, w in mix])[0]
+            width = self.random.choice(widths)
+            self.posts.append({'id': post_id, 'file_ext': 'jpg', 'image_width': width, 'image_height': round(width / ratio)})
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def count(self, stat, amount=1):
+        with self.lock:
+            self.stats[stat] += amount
+
+    def chance(self, probability):
+        with self.lock:
+            return self.random.random() < probability
+
+    def image_file(self, post):
+        """Returns the JPEG body of a post: the rows of each band are taken from the render of its size starting at
+        an offset picked by the post ID, and the ID is appended after EOI so no two files are byte-identical."""
+        size = (post['image_width'], post['image_height'])
+        with self.generate_lock:
+            cached = self.images.get(size)
+            if cached is None:
+                cached = self.images[size] = self.generate_image(size)
+        header, segments = cached
+        rows = len(segments)
+        offsets = [random.Random(post['id'] * IMAGE_BANDS + band).randrange(rows) for band in range(IMAGE_BANDS)]
+        parts = [header]
+        for row in range(rows):
+            if row:
+                parts.append(bytes([0xFF, 0xD0 + (row - 1) % 8]))
+            parts.append(segments[(row + offsets[row * IMAGE_BANDS // rows]) % rows])
+        parts.append(b'\xff\xd9' + f"post-{post['id']}".encode())
+        return b''.join(parts)
+
+    def file_info(self, post):
+        """Returns (file size, md5) of a post's image."""
+        info = self.files.get(post['id'])
+        if info is None:
+            body = self.image_file(post)
+            info = self.files[post['id']] = (len(body), hashlib.md5(body).hexdigest())
+        return info
+
+    @staticmethod
+    def generate_image(size):
+        # Upscaled noise compresses roughly like a real illustration, unlike a flat colour. A restart marker after
+        # every MCU row makes the rows independently decodable, so they can be spliced back in any order.
+        small = (max(1, size[0] // 16), max(1, size[1] // 16))
+        bands = [Image.effect_noise(small, 64).resize(size, Image.BILINEAR) for _ in range(3)]
+        buffer = io.BytesIO()
+        Image.merge('RGB', bands).save(buffer, 'JPEG', quality=90, restart_marker_rows=1)
+        data = buffer.getvalue()
+        scan = data.index(b'\xff\xda')
+        scan += 2 + int.from_bytes(data[scan + 2:scan + 4], 'big')
+        return data[:scan], RESTART_MARKER_RE.split(data[scan:data.rindex(b'\xff\xd9')])
+
+    def matching_posts(self, tags):
+        """Applies the ratio: metatag the way Danbooru does. Each plain tag matches a fixed two thirds of the
+        posts, so different queries overlap only partly; tags listed in empty_tags match nothing."""
+        posts = self.posts
+        for tag in tags.split():
+            match = RATIO_TAG_RE.match(tag)
+            if match:
+                low, high = float(match.group(1)), float(match.group(2))
+                posts = [p for p in posts if low <= p['image_width'] / p['image_height'] <= high]
+            elif tag in self.empty_tags:
+                return []
+            elif ':' not in tag:
+                posts = [p for p in posts if zlib.crc32(f"{tag}:{p['id']}".encode()) % 3]
+        return posts
+
+    def variants(self, post):
+        """Returns {variant type: (width, height)} of the smaller versions of a post: a thumbnail, plus a sample
+        sample_width wide if the original is wider than that."""
+        width, height = post['image_width'], post['image_height']
+        scale = THUMBNAIL_BOX / max(width, height)
+        variants = {'180x180': (max(1, round(width * scale)), max(1, round(height * scale)))}
+        if width > self.sample_width:
+            variants['sample'] = (self.sample_width, round(height * self.sample_width / width))
+        return variants
+
+    def variant_file(self, post, variant_type):
+        """Returns the JPEG body of a variant, or None if the post has no variant of that type."""
+        size = self.variants(post).get(variant_type)
+        if size is None:
+            return None
+        return self.image_file({'id': post['id'], 'image_width': size[0], 'image_height': size[1]})
+
+    def post_tags(self, post):
+        return ' '.join(tag for tag in FAKE_TAGS if zlib.crc32(f"{tag}:{post['id']}".encode()) % 3)
+
+    def post_json(self, post):
+        file_size, md5 = self.file_info(post)
+        file_url = f"{self.base_url}/data/{post['id']}.jpg"
+        variants = [{'type': variant_type, 'url': f"{self.base_url}/data/{variant_type}/{post['id']}.jpg",
+                     'width': width, 'height': height, 'file_ext': 'jpg'}
+                    for variant_type, (width, height) in self.variants(post).items()]
+        variants.append({'type': 'original', 'url': file_url, 'width': post['image_width'], 'height': post['image_height'], 'file_ext': 'jpg'})
+        return dict(post, file_url=file_url, file_size=file_size, md5=md5, media_asset={'variants': variants})
+
+
+class FakeDanbooruHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, status, body, content_type='application/json', headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.count('bytes_sent', len(body))
+
+    def send_json(self, data):
+        """Sends data with an ETag of its contents, or just 304 Not Modified if the client already has them."""
+        body = json.dumps(data).encode()
+        etag = f'"{hashlib.md5(body).hexdigest()}"'
+        if self.headers.get('If-None-Match') == etag:
+            self.server.count('not_modified')
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.send_body(200, body, headers={'ETag': etag})
+
+    def drop(self, partial_body=b''):
+        """Closes the connection mid-response, the way a flaky network or proxy would."""
+        self.server.count('dropped')
+        if partial_body:
+            self.wfile.write(partial_body)
+            self.server.count('bytes_sent', len(partial_body))
+        self.wfile.flush()
+        self.close_connection = True
+
+    def do_GET(self):
+        server = self.server
+        url = urlparse(self.path)
+        query = {name: values[0] for name, values in parse_qs(url.query).items()}
+        if url.path == '/_bench/stats':
+            with server.lock:
+                stats = dict(server.stats)
+            return self.send_json(stats)
+
+        if server.latency or server.jitter:
+            time.sleep(server.latency + server.jitter * server.random.random())
+        if server.chance(server.rate_429):
+            server.count('throttled')
+            return self.send_body(429, b'{}', headers={'Retry-After': str(server.retry_after)})
+
+        if url.path == '/counts/posts.json':
+            server.count('api_requests')
+            if server.chance(server.drop_rate):
+                return self.drop()
+            return self.send_json({'counts': {'posts': len(server.matching_posts(query.get('tags', '')))}})
+
+        if url.path == '/posts.json':
+            server.count('api_requests')
+            if server.chance(server.drop_rate):
+                return self.drop()
+            limit = min(int(query.get('limit', 20)), 200)
+            page = int(query.get('page', 1))
+            posts = server.matching_posts(query.get('tags', ''))[(page - 1) * limit:page * limit]
+            return self.send_json([server.post_json(post) for post in posts])
+
+        match = re.match(r'^/posts/(\d+)\.json$', url.path)
+        if match and 1 <= int(match.group(1)) <= len(server.posts):
+            server.count('api_requests')
+            post = server.posts[int(match.group(1)) - 1]
+            return self.send_json({'id': post['id'], 'tag_string': server.post_tags(post)})
+
+        match = re.match(r'^/data/(?:([\w-]+)/)?(\d+)\.jpg$', url.path)
+        if match and 1 <= int(match.group(2)) <= len(server.posts):
+            server.count('image_requests')
+            post = server.posts[int(match.group(2)) - 1]
+            if match.group(1):
+                server.count('variant_requests')
+                body = server.variant_file(post, match.group(1))
+                if body is None:
+                    return self.send_body(404, b'{}')
+            else:
+                body = server.image_file(post)
+            start = 0
+            range_match = re.match(r'^bytes=(\d+)-$', self.headers.get('Range', ''))
+            if range_match and int(range_match.group(1)) < len(body):
+                server.count('range_requests')
+                start = int(range_match.group(1))
+            if server.chance(server.drop_rate):
+                self.send_response(206 if start else 200)
+                self.send_header('Content-Length', str(len(body) - start))
+                self.end_headers()
+                return self.drop(body[start:start + (len(body) - start) // 2])
+            if start:
+                return self.send_body(206, body[start:], 'image/jpeg', {'Content-Range': f"bytes {start}-{len(body) - 1}/{len(body)}"})
+            return self.send_body(200, body, 'image/jpeg')
+
+        self.send_body(404, b'{}')
+
+
+def add_server_arguments(parser):
+    """Adds the server options, shared with the benchmark runner."""
+    parser.add_argument('--posts', type=int, default=2000, help="Total number of fake posts.")
+    parser.add_argument('--aspect-mix', default=DEFAULT_ASPECT_MIX, help="Weighted aspect ratios of the posts, e.g. \"16:9=0.6,4:3=0.4\".")
+    parser.add_argument('--widths', default=DEFAULT_WIDTHS, help="Comma-separated image widths to pick from.")
+    parser.add_argument('--latency-ms', type=float, default=0, help="Delay added to every response.")
+    parser.add_argument('--jitter-ms', type=float, default=0, help="Random extra delay of up to this much.")
+    parser.add_argument('--rate-429', type=float, default=0.0, help="Fraction of requests answered with 429 Too Many Requests.")
+    parser.add_argument('--retry-after', type=int, default=1, help="Retry-After seconds sent with each 429.")
+    parser.add_argument('--drop-rate', type=float, default=0.0, help="Fraction of responses cut off mid-transfer.")
+    parser.add_argument('--empty-tags', default="", help="Comma-separated tags that match no posts, to exercise empty queries.")
+    parser.add_argument('--sample-width', type=int, default=1920, help="Width of the 'sample' variant offered for wider images.")
+    parser.add_argument('--seed', type=int, default=1)
+
+def server_from_args(args, port=0):
+    return FakeDanbooruServer(('127.0.0.1', port), posts=args.posts, aspect_mix=args.aspect_mix, widths=args.widths,
+                              latency_ms=args.latency_ms, jitter_ms=args.jitter_ms, rate_429=args.rate_429,
+                              retry_after=args.retry_after, drop_rate=args.drop_rate, empty_tags=args.empty_tags,
+                              sample_width=args.sample_width, seed=args.seed)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=8000)
+    add_server_arguments(parser)
+    args = parser.parse_args()
+    server = server_from_args(args, args.port)
+    print(f"Serving {args.posts} fake posts on {server.base_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
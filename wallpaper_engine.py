@@ -0,0 +1,2432 @@
+import requests
+import requests.adapters
+import urllib3.connection
+import urllib3.poolmanager
+from PIL import Image, ImageOps
+import ctypes
+import threading
+import time
+import os
+import random
+import math
+import re
+import collections
+import email.utils
+import json
+import hashlib
+import concurrent.futures
+import array
+import struct
+import contextlib
+import http.server
+import shlex
+import shutil
+import sqlite3
+import subprocess
+import sys
+
+# --- Constants ---
+APP_NAME = "Infinity_Wallpaper"
+VERSION = "2.6" # Final Polish
+SAVED_WALLPAPERS_DIR = os.path.join(os.path.expanduser('~'), 'Pictures', APP_NAME)
+CACHE_DIR = os.path.join(os.getenv('LOCALAPPDATA') or os.path.join(os.path.expanduser('~'), '.cache'), APP_NAME, 'cache')
+CACHE_BUDGET = 1024 * 1024 * 1024 # Bytes of fitted wallpapers kept for reuse and offline rotation
+PREVIEW_CACHE_DIR = os.path.join(os.path.dirname(CACHE_DIR), 'previews')
+PREVIEW_MEMORY_ITEMS = 2 # Decoded previews kept in memory
+PREVIEW_DISK_BUDGET = 50 * 1024 * 1024
+PREVIEW_JPEG_QUALITY = 85
+LIBRARY_DB_PATH = os.path.join(os.path.dirname(CACHE_DIR), 'library.sqlite3') # Index of the wallpapers saved to SAVED_WALLPAPERS_DIR
+THUMBNAIL_DIR = os.path.join(os.path.dirname(CACHE_DIR), 'thumbnails')
+THUMBNAIL_SIZE = (192, 108)
+THUMBNAIL_MEMORY_ITEMS = 256 # Decoded thumbnails kept in memory, a few screens of the gallery
+THUMBNAIL_JPEG_QUALITY = 80
+FICLONE = 0x40049409 # Linux ioctl that clones a file copy-on-write (a reflink) on Btrfs, XFS and similar
+ASPECT_RATIO_16_9 = 16 / 9
+ASPECT_RATIO_TOLERANCE = 0.1
+CROP_MIN_AREA = 0.55 # Share of a post a crop-to-fit window must keep; sets how far from the screen's shape a post may be
+CROP_ANALYSIS_SIZE = 160 # Long side in pixels of the copy the crop window is chosen on
+CROP_CONTRAST_WEIGHT = 0.5 # Weight of contrast against the mean colour next to edge detail in the crop score
+CROP_CENTER_BIAS = 0.15 # Score penalty at the very edge of the image, so flat images still crop to the centre
+ALLOWED_EXTENSIONS = ['jpg', 'jpeg', 'png', 'gif']
+RATINGS = ["general", "sensitive", "questionable", "explicit"]
+DEFAULT_TAGS = "1girl solo"
+DEFAULT_RATING = "general"
+DEFAULT_INTERVAL = 300 # Seconds between wallpaper changes
+PREFETCH_QUEUE_SIZE = 3 # Number of downloaded wallpapers kept ready ahead of time
+PREFETCH_DISK_BUDGET = 200 * 1024 * 1024 # Max bytes the prefetch queue may hold on disk
+POST_POOL_LOW_WATER = 5 # Fetch another page once fewer candidates than this are left
+POST_POOL_TTL = 6 * 60 * 60 # Seconds before a pooled candidate is considered stale
+DANBOORU_URL = "https://danbooru.donmai.us"
+DANBOORU_TAG_LIMIT = 2 # Anonymous searches may only contain this many tags besides rating:
+DANBOORU_PAGE_LIMIT = 1000 # Danbooru rejects page numbers above this
+POSTS_PER_PAGE = 100
+POST_FIELDS = "id,file_url,file_ext,image_width,image_height,file_size,md5,media_asset[variants]" # Everything the slideshow reads from a post
+DEFAULT_SCREEN_SIZE = (1920, 1080) # Used when the real resolution cannot be detected
+WALLPAPER_JPEG_QUALITY = 92
+POST_COUNT_TTL = 60 * 60 # Seconds to trust a cached result count for a query
+HTTP_POOL_SIZE = 4 # Keep-alive connections kept open per host
+HTTP_RATE_LIMIT = 10 # Requests per second; Danbooru's limit for anonymous reads
+HTTP_RATE_BURST = 10
+HTTP_MAX_RETRIES = 4
+HTTP_BACKOFF_BASE = 1 # Seconds; doubled on every retry, with jitter
+HTTP_BACKOFF_MAX = 60
+HTTP_VALIDATOR_CACHE_SIZE = 64 # List responses remembered for ETag/If-Modified-Since
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+DOWNLOAD_MAX_BYTES = 100 * 1024 * 1024 # Refuse originals larger than this
+DOWNLOAD_MAX_RESUMES = 3 # Range requests attempted after a dropped connection
+FETCH_BACKOFF_BASE = 5 # Seconds the prefetcher waits after its first failed cycle, doubled per failure
+FETCH_BACKOFF_MAX = 300
+PLAYLIST_REFILL_WORKERS = 3 # Playlist entries whose candidate pools are refilled at the same time
+PLAYLIST_BACKOFF_BASE = 60 # Seconds an entry that found nothing is skipped for, doubled each time it comes up empty again
+PLAYLIST_BACKOFF_MAX = 60 * 60
+HISTORY_PATH = os.path.join(os.path.dirname(CACHE_DIR), 'history.bin')
+HISTORY_MAGIC = b'IWH1'
+HISTORY_RECENT_SIZE = 100000 # Shown post IDs remembered exactly; older ones go into the Bloom filters
+HISTORY_BLOOM_BITS = 8 * 1024 * 1024 # Per filter (1 MB); two filters are kept
+HISTORY_BLOOM_HASHES = 7
+HISTORY_BLOOM_CAPACITY = 800000 # IDs per filter before it is rotated out, ~1% false positives at this fill
+HISTORY_HASH_SIZE = 5000 # Image hashes of recent wallpapers checked for near-duplicates
+HISTORY_SAVE_INTERVAL = 10 * 60 # Seconds between history saves while running
+HISTORY_STALE_PAGES = 3 # Pages of only already-shown posts tried before repeats are allowed for a query
+DHASH_BANDS = 8
+DHASH_MAX_DISTANCE = 6 # Bits two image hashes may differ by and still count as the same picture; must be below DHASH_BANDS
+PREFETCH_ATTEMPTS = 3 # Posts tried per monitor before a prefetch cycle gives up
+SNAPSHOT_PATH = os.path.join(os.path.dirname(CACHE_DIR), 'snapshot.json')
+SNAPSHOT_VERSION = 1
+SNAPSHOT_CANDIDATES = 25 # Pooled candidates kept per query in the warm-start snapshot
+METRICS_WINDOW = 1024 # Recent samples kept per timer for percentiles
+METRICS_LOG_PATH = os.path.join(os.path.dirname(CACHE_DIR), 'metrics.jsonl')
+METRICS_LOG_MAX_BYTES = 5 * 1024 * 1024 # The JSONL metrics log is rotated at this size
+
+
+# --- Windows API for setting wallpaper ---
+SPI_SETDESKWALLPAPER = 20
+SPIF_UPDATEINIFILE = 1
+SPIF_SENDCHANGE = 2
+WALLPAPER_STYLE_SPAN = "22"
+
+def set_wallpaper(path):
+    """Sets the desktop wallpaper for Windows."""
+    abs_path = os.path.abspath(path)
+    if sys.platform == "win32":
+        try:
+            ctypes.windll.user32.SystemParametersInfoW(SPI_SETDESKWALLPAPER, 0, abs_path, SPIF_UPDATEINIFILE | SPIF_SENDCHANGE)
+        except Exception as e:
+            print(f"Error setting wallpaper: {e}")
+            return False
+    else:
+        print("Wallpaper setting is only supported on Windows.")
+        return False
+    return True
+
+def set_wallpaper_style(style):
+    """Sets how Windows fits the wallpaper to the desktop, e.g. WALLPAPER_STYLE_SPAN."""
+    if sys.platform != "win32":
+        return False
+    import winreg
+    try:
+        with winreg.OpenKey(winreg.HKEY_CURRENT_USER, r"Control Panel\Desktop", 0, winreg.KEY_SET_VALUE) as key:
+            winreg.SetValueEx(key, "WallpaperStyle", 0, winreg.REG_SZ, style)
+            winreg.SetValueEx(key, "TileWallpaper", 0, winreg.REG_SZ, "0")
+    except OSError as e:
+        print(f"Error setting wallpaper style: {e}")
+        return False
+    return True
+
+def get_screen_size():
+    """Returns the physical resolution of the primary display."""
+    if sys.platform == "win32":
+        try:
+            # DESKTOPHORZRES/DESKTOPVERTRES are not affected by display scaling.
+            hdc = ctypes.windll.user32.GetDC(0)
+            width = ctypes.windll.gdi32.GetDeviceCaps(hdc, 118)
+            height = ctypes.windll.gdi32.GetDeviceCaps(hdc, 117)
+            ctypes.windll.user32.ReleaseDC(0, hdc)
+            if width > 0 and height > 0:
+                return (width, height)
+        except Exception as e:
+            print(f"Error reading screen size: {e}")
+    return DEFAULT_SCREEN_SIZE
+
+
+# --- Wallpaper backends ---
+class WallpaperBackend:
+    """Applies an image file as the desktop wallpaper. Subclasses implement set_wallpaper."""
+    name = "wallpaper backend"
+
+    def set_wallpaper(self, path):
+        raise NotImplementedError
+
+    def set_style(self, style):
+        """Switches how the wallpaper is fitted to the desktop. Backends that cannot do this return False."""
+        return False
+
+
+class WindowsBackend(WallpaperBackend):
+    """Sets the wallpaper through SystemParametersInfoW."""
+    name = "Windows API"
+
+    def set_wallpaper(self, path):
+        return set_wallpaper(path)
+
+    def set_style(self, style):
+        return set_wallpaper_style(style)
+
+
+class CommandBackend(WallpaperBackend):
+    """Runs a command to set the wallpaper, e.g. "feh --bg-fill {path}". {path} is replaced by the absolute image path."""
+    name = "wallpaper command"
+
+    def __init__(self, command):
+        self.args = shlex.split(command)
+        if not any('{path}' in arg for arg in self.args):
+            self.args.append('{path}')
+
+    def set_wallpaper(self, path):
+        abs_path = os.path.abspath(path)
+        try:
+            subprocess.run([arg.replace('{path}', abs_path) for arg in self.args], check=True, timeout=30)
+        except (OSError, subprocess.SubprocessError) as e:
+            print(f"Error setting wallpaper: {e}")
+            return False
+        return True
+
+
+class FileSinkBackend(WallpaperBackend):
+    """Copies each wallpaper to a fixed file instead of touching the desktop. Used for tests and benchmarks."""
+    name = "file sink"
+
+    def __init__(self, output_path):
+        self.output_path = output_path
+        self.history = [] # (time.monotonic(), source path) for every wallpaper applied
+
+    def set_wallpaper(self, path):
+        temp_path = f"{self.output_path}.tmp"
+        try:
+            shutil.copyfile(path, temp_path)
+            os.replace(temp_path, self.output_path)
+        except OSError as e:
+            print(f"Error writing wallpaper: {e}")
+            return False
+        self.history.append((time.monotonic(), path))
+        return True
+
+def default_backend():
+    """Returns the backend for this platform, or None if there is no built-in one."""
+    if sys.platform == "win32":
+        return WindowsBackend()
+    return None
+
+
+# --- Metrics ---
+class Histogram:
+    """Timings of one stage: lifetime count and sum, plus the most recent samples in a ring buffer for percentiles."""
+    def __init__(self, window=METRICS_WINDOW):
+        self.samples = collections.deque(maxlen=window)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.samples.append(value)
+        self.count += 1
+        self.sum += value
+
+    def summary(self):
+        ordered = sorted(self.samples)
+        def quantile(q):
+            return ordered[min(len(ordered) - 1, int(q * len(ordered)))] if ordered else 0.0
+        return {'count': self.count, 'sum': self.sum, 'p50': quantile(0.5), 'p90': quantile(0.9), 'p99': quantile(0.99), 'max': ordered[-1] if ordered else 0.0}
+
+
+class Metrics:
+    """Counters and per-stage timers for the whole slideshow. Cheap enough to stay on: one lock and a deque append per sample."""
+    def __init__(self, window=METRICS_WINDOW):
+        self.window = window
+        self.counters = collections.Counter()
+        self.histograms = {}
+        self.log = None
+        self.lock = threading.Lock()
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] += amount
+
+    def observe(self, name, seconds):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram(self.window)
+            histogram.observe(seconds)
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        """Times the enclosed block as one sample of the named stage."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def samples(self, name):
+        """Returns the recent samples of a timer, oldest first."""
+        with self.lock:
+            histogram = self.histograms.get(name)
+            return list(histogram.samples) if histogram else []
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    def snapshot(self):
+        """Returns all counters and a summary of every timer (in seconds) as plain data."""
+        with self.lock:
+            return {
+                'counters': dict(self.counters),
+                'timers': {name: histogram.summary() for name, histogram in self.histograms.items()},
+            }
+
+    def prometheus_text(self):
+        """Renders the snapshot in the Prometheus text exposition format; timers become summaries."""
+        prefix = APP_NAME.lower()
+        snapshot = self.snapshot()
+        lines = []
+        for name, value in sorted(snapshot['counters'].items()):
+            lines.append(f"# TYPE {prefix}_{name}_total counter")
+            lines.append(f"{prefix}_{name}_total {value}")
+        for name, summary in sorted(snapshot['timers'].items()):
+            metric = f"{prefix}_{name}_seconds"
+            lines.append(f"# TYPE {metric} summary")
+            for quantile in ('p50', 'p90', 'p99'):
+                lines.append(f'{metric}{{quantile="0.{quantile[1:]}"}} {summary[quantile]:.6f}')
+            lines.append(f"{metric}_sum {summary['sum']:.6f}")
+            lines.append(f"{metric}_count {summary['count']}")
+        return '\n'.join(lines) + '\n'
+
+    def open_log(self, path, max_bytes=METRICS_LOG_MAX_BYTES):
+        self.log = MetricsLog(path, max_bytes)
+
+    def write_log(self, record):
+        """Appends a record, together with the current snapshot, to the JSONL log if one is open."""
+        if self.log:
+            self.log.write(dict(record, time=time.time(), **self.snapshot()))
+
+
+class MetricsLog:
+    """Append-only JSONL file that is rotated to <path>.1 once it grows past max_bytes, so it stays bounded."""
+    def __init__(self, path, max_bytes=METRICS_LOG_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    def write(self, record):
+        line = json.dumps(record, separators=(',', ':')) + '\n'
+        with self.lock:
+            try:
+                if os.path.exists(self.path) and os.path.getsize(self.path) + len(line) > self.max_bytes:
+                    os.replace(self.path, f"{self.path}.1")
+                with open(self.path, 'a', encoding='utf-8') as f:
+                    f.write(line)
+            except OSError as e:
+                print(f"Could not write metrics log: {e}")
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    """Serves /metrics (Prometheus text) and /metrics.json."""
+    def do_GET(self):
+        if self.path == '/metrics':
+            body, content_type = metrics.prometheus_text().encode('utf-8'), 'text/plain; version=0.0.4'
+        elif self.path == '/metrics.json':
+            body, content_type = json.dumps(metrics.snapshot()).encode('utf-8'), 'application/json'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_metrics_server(port):
+    """Serves the metrics on localhost only. The thread blocks in accept(), so it costs nothing between scrapes."""
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', port), MetricsHandler)
+    server.daemon_threads = True
+    def _serve():
+        while True:
+            server.handle_request()
+    threading.Thread(target=_serve, daemon=True).start()
+    return server
+
+metrics = Metrics()
+
+
+# --- HTTP client ---
+def backoff_delay(attempt, base, cap):
+    """Returns a jittered exponential delay for the given retry attempt (0-based)."""
+    return random.uniform(base / 2, min(cap, base * (2 ** attempt)))
+
+def parse_retry_after(response):
+    """Returns the number of seconds a Retry-After header asks us to wait, or None."""
+    value = response.headers.get('Retry-After') if response is not None else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class DownloadError(Exception):
+    """Raised when a download is too large or does not match the post's metadata."""
+
+
+class TokenBucket:
+    """Token-bucket rate limiter shared by every request the app makes."""
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Blocks until a token is available and returns how long it waited."""
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+
+class ConnectCounter:
+    """Connection mixin that calls on_connect every time a socket is opened, including when urllib3 reconnects
+    a connection object the server closed, so it counts every TCP (and TLS) handshake."""
+    def __init__(self, *args, on_connect=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.on_connect = on_connect
+
+    def connect(self):
+        if self.on_connect:
+            self.on_connect()
+        super().connect()
+
+class CountingHTTPConnection(ConnectCounter, urllib3.connection.HTTPConnection):
+    pass
+
+class CountingHTTPSConnection(ConnectCounter, urllib3.connection.HTTPSConnection):
+    pass
+
+class CountingPoolManager(urllib3.poolmanager.PoolManager):
+    """Pool manager whose pools open their connections through ConnectCounter."""
+    def __init__(self, on_connect, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.on_connect = on_connect
+
+    def _new_pool(self, scheme, host, port, request_context=None):
+        pool = super()._new_pool(scheme, host, port, request_context)
+        pool.ConnectionCls = CountingHTTPSConnection if scheme == 'https' else CountingHTTPConnection
+        pool.conn_kw['on_connect'] = self.on_connect
+        return pool
+
+class CountingHTTPAdapter(requests.adapters.HTTPAdapter):
+    def __init__(self, on_connect, **kwargs):
+        self.on_connect = on_connect # Needed by init_poolmanager(), which the base constructor calls
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, connections, maxsize, block=False, **pool_kwargs):
+        super().init_poolmanager(connections, maxsize, block, **pool_kwargs)
+        self.poolmanager = CountingPoolManager(self.on_connect, num_pools=connections, maxsize=maxsize, block=block, **pool_kwargs)
+
+
+class HttpClient:
+    """Single HTTP layer for all network access: pooled keep-alive connections, rate limiting,
+    retries with jittered exponential backoff and conditional list requests."""
+    def __init__(self, base_url=DANBOORU_URL, rate=HTTP_RATE_LIMIT, burst=HTTP_RATE_BURST, max_retries=HTTP_MAX_RETRIES):
+        self.base_url = base_url.rstrip('/')
+        self.max_retries = max_retries
+        self.rate_limiter = TokenBucket(rate, burst)
+        self.session = requests.Session()
+        self.session.headers['User-Agent'] = f'{APP_NAME}/{VERSION}'
+        self.adapter = CountingHTTPAdapter(self._on_connect, pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE, max_retries=0)
+        self.session.mount('http://', self.adapter)
+        self.session.mount('https://', self.adapter)
+        self.validators = collections.OrderedDict() # request key -> (etag, last_modified, parsed body)
+        self.stats = {'requests': 0, 'retries': 0, 'not_modified': 0, 'resumes': 0, 'handshakes': 0, 'backoff_seconds': 0.0, 'throttled_seconds': 0.0}
+        self.lock = threading.Lock()
+
+    def _count(self, stat, amount=1):
+        with self.lock:
+            self.stats[stat] += amount
+
+    def _on_connect(self):
+        self._count('handshakes')
+        metrics.count('http_connects')
+
+    def get_stats(self):
+        with self.lock:
+            return dict(self.stats)
+
+    def url(self, path):
+        """Resolves an API path against the base URL; absolute URLs are returned unchanged."""
+        return path if '://' in path else f"{self.base_url}{path}"
+
+    def get(self, url, timeout=20, **kwargs):
+        """Performs a GET, retrying transient failures, and returns the successful response."""
+        url = self.url(url)
+        attempt = 0
+        while True:
+            self._count('throttled_seconds', self.rate_limiter.acquire())
+            self._count('requests')
+            metrics.count('http_requests')
+            try:
+                with metrics.timer('http_request'):
+                    response = self.session.get(url, timeout=timeout, **kwargs)
+            except requests.exceptions.ConnectionError:
+                if attempt >= self.max_retries:
+                    raise
+                # A reset keep-alive connection usually succeeds straight away on a fresh one.
+                delay = 0.0 if attempt == 0 else backoff_delay(attempt, HTTP_BACKOFF_BASE, HTTP_BACKOFF_MAX)
+            except requests.exceptions.Timeout:
+                if attempt >= self.max_retries:
+                    raise
+                delay = backoff_delay(attempt, HTTP_BACKOFF_BASE, HTTP_BACKOFF_MAX)
+            else:
+                if response.status_code not in RETRYABLE_STATUS_CODES or attempt >= self.max_retries:
+                    if response.status_code != 304:
+                        response.raise_for_status()
+                    if not kwargs.get('stream'):
+                        # API payloads; streamed image bodies are counted as download_bytes instead.
+                        metrics.count('http_response_bytes', len(response.content))
+                    return response
+                metrics.count(f"http_status_{response.status_code}")
+                retry_after = parse_retry_after(response)
+                delay = backoff_delay(attempt, HTTP_BACKOFF_BASE, HTTP_BACKOFF_MAX)
+                if retry_after is not None:
+                    delay = min(max(delay, retry_after), HTTP_BACKOFF_MAX)
+                response.close()
+            attempt += 1
+            self._count('retries')
+            metrics.count('http_retries')
+            self._count('backoff_seconds', delay)
+            time.sleep(delay)
+
+    def get_json(self, path, params=None, conditional=False):
+        """GETs a JSON document. With conditional=True, repeated queries send ETag/If-Modified-Since and reuse the cached body on 304."""
+        if not conditional:
+            return self.get(path, params=params, timeout=15).json()
+
+        key = (self.url(path), tuple(sorted((params or {}).items())))
+        with self.lock:
+            cached = self.validators.get(key)
+        headers = {}
+        if cached:
+            etag, last_modified, _ = cached
+            if etag:
+                headers['If-None-Match'] = etag
+            if last_modified:
+                headers['If-Modified-Since'] = last_modified
+        response = self.get(path, params=params, headers=headers, timeout=15)
+        if response.status_code == 304 and cached:
+            self._count('not_modified')
+            metrics.count('http_not_modified')
+            with self.lock:
+                self.validators.move_to_end(key)
+            return cached[2]
+
+        body = response.json()
+        etag, last_modified = response.headers.get('ETag'), response.headers.get('Last-Modified')
+        if etag or last_modified:
+            with self.lock:
+                self.validators[key] = (etag, last_modified, body)
+                self.validators.move_to_end(key)
+                while len(self.validators) > HTTP_VALIDATOR_CACHE_SIZE:
+                    self.validators.popitem(last=False)
+        return body
+
+    def download(self, url, dest_path, expected_size=None, expected_md5=None, max_bytes=DOWNLOAD_MAX_BYTES):
+        """Streams url to dest_path in chunks and returns the number of bytes written.
+
+        The data goes to a .part file first and is only renamed into place once its size
+        and md5 match the post metadata. A dropped connection resumes with an HTTP Range request.
+        """
+        if expected_size and expected_size > max_bytes:
+            raise DownloadError(f"File is {expected_size} bytes, over the {max_bytes} byte limit.")
+        part_path = f"{dest_path}.part"
+        digest = hashlib.md5()
+        written = 0
+        resumes = 0
+        try:
+            with open(part_path, 'wb') as f:
+                while True:
+                    headers = {'Range': f"bytes={written}-"} if written else {}
+                    try:
+                        with self.get(url, timeout=20, stream=True, headers=headers) as response:
+                            if written and response.status_code != 206:
+                                # The server ignored the Range header, so start over.
+                                f.seek(0)
+                                f.truncate()
+                                digest = hashlib.md5()
+                                written = 0
+                            for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                                written += len(chunk)
+                                if written > max_bytes:
+                                    raise DownloadError(f"Download exceeded the {max_bytes} byte limit.")
+                                digest.update(chunk)
+                                f.write(chunk)
+                                metrics.count('download_bytes', len(chunk))
+                        break
+                    except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError):
+                        if resumes >= DOWNLOAD_MAX_RESUMES:
+                            raise
+                        resumes += 1
+                        self._count('resumes')
+                        metrics.count('download_resumes')
+            if expected_size and written != expected_size:
+                raise DownloadError(f"Expected {expected_size} bytes but received {written}.")
+            if expected_md5 and digest.hexdigest() != expected_md5:
+                raise DownloadError("Downloaded file does not match its md5.")
+            os.replace(part_path, dest_path)
+        except BaseException:
+            if os.path.exists(part_path):
+                os.remove(part_path)
+            raise
+        return written
+
+
+# --- Danbooru fetching ---
+def ratio_range(aspect_ratio, crop=False):
+    """Returns the (low, high) range of post aspect ratios usable on a screen of aspect_ratio.
+
+    Normally that is the screen's own shape give or take ASPECT_RATIO_TOLERANCE; with crop, any shape whose
+    screen-shaped crop keeps at least CROP_MIN_AREA of the image.
+    """
+    if crop:
+        return aspect_ratio * CROP_MIN_AREA, aspect_ratio / CROP_MIN_AREA
+    return aspect_ratio - ASPECT_RATIO_TOLERANCE, aspect_ratio + ASPECT_RATIO_TOLERANCE
+
+def is_suitable_post(post, aspect_ratio=ASPECT_RATIO_16_9, crop=False):
+    """Returns True if a post has an allowed file type and an aspect ratio in ratio_range() (around 16:9 by default)."""
+    if 'file_ext' not in post or post['file_ext'] not in ALLOWED_EXTENSIONS:
+        return False
+    if 'file_url' in post and 'image_width' in post and 'image_height' in post:
+        w, h = post['image_width'], post['image_height']
+        low, high = ratio_range(aspect_ratio, crop)
+        return h > 0 and low < w / h < high
+    return False
+
+def build_search_tags(tags, rating, aspect_ratio=ASPECT_RATIO_16_9, crop=False):
+    """Builds the Danbooru tag query, moving the file type and aspect ratio filters to the server while the tag limit allows."""
+    search_tags = tags.split()
+    low, high = ratio_range(aspect_ratio, crop)
+    # Ordered by how much they cut: most posts have an allowed file type, few have the screen's shape.
+    server_filters = [
+        f"ratio:{low:.2f}..{high:.2f}",
+        f"filetype:{','.join(ALLOWED_EXTENSIONS)}",
+    ]
+    for server_filter in server_filters:
+        if len(search_tags) < DANBOORU_TAG_LIMIT:
+            search_tags.append(server_filter)
+    search_tags.append(f"rating:{rating}")
+    return ' '.join(search_tags)
+
+def fetch_post_count(http_client, search_tags):
+    """Returns how many posts match a tag query, or None if Danbooru could not count them."""
+    with metrics.timer('count_fetch'):
+        counts = http_client.get_json("/counts/posts.json", params={'tags': search_tags}, conditional=True)
+    return counts.get('counts', {}).get('posts')
+
+def fetch_post_tags(http_client, post_id):
+    """Returns a post's tags as one space-separated string."""
+    post = http_client.get_json(f"/posts/{post_id}.json", params={'only': 'tag_string'})
+    return post.get('tag_string', "")
+
+def fetch_suitable_posts(http_client, tags, rating, page, aspect_ratio=ASPECT_RATIO_16_9, crop=False):
+    """Fetches one page of posts and returns the ones that fit the screen, or can be cropped to fit with crop."""
+    params = {'tags': build_search_tags(tags, rating, aspect_ratio, crop), 'limit': POSTS_PER_PAGE, 'page': page, 'only': POST_FIELDS}
+    with metrics.timer('list_fetch'):
+        posts = http_client.get_json("/posts.json", params=params, conditional=True)
+    # The server-side filters are skipped once the tag limit is reached, so always check locally too.
+    suitable = [post for post in posts if is_suitable_post(post, aspect_ratio, crop)]
+    metrics.count('posts_listed', len(posts))
+    metrics.count('posts_filtered_out', len(posts) - len(suitable))
+    if not posts:
+        metrics.count('empty_pages')
+    return suitable
+
+
+class PostPool:
+    """Keeps the filtered candidates of every fetched page, per (tags, rating, aspect ratio), so one API call feeds many wallpapers.
+
+    With crop, candidates are filtered for crop-to-fit mode, which accepts a much wider range of shapes.
+    """
+    def __init__(self, http_client, low_water=POST_POOL_LOW_WATER, ttl=POST_POOL_TTL, history=None, crop=False):
+        self.http_client = http_client
+        self.history = history
+        self.crop = crop
+        self.low_water = low_water
+        self.ttl = ttl
+        self.entries = {} # (tags, rating, aspect ratio) -> {post id: (expires_at, post)}
+        self.page_counts = {} # (tags, rating, aspect ratio) -> (expires_at, number of pages)
+        self.refill_locks = {} # (tags, rating, aspect ratio) -> lock held while that query is being refilled
+        self.lock = threading.Lock()
+
+    def _live_entries(self, key):
+        """Returns the pool for key with expired candidates dropped."""
+        now = time.monotonic()
+        pool = self.entries.setdefault(key, {})
+        for post_id in [post_id for post_id, (expires_at, _) in pool.items() if expires_at <= now]:
+            del pool[post_id]
+        return pool
+
+    @staticmethod
+    def _key(tags, rating, aspect_ratio):
+        return (tags, rating, round(aspect_ratio, 2))
+
+    def size(self, tags, rating, aspect_ratio=ASPECT_RATIO_16_9):
+        with self.lock:
+            return len(self._live_entries(self._key(tags, rating, aspect_ratio)))
+
+    def needs_refill(self, tags, rating, aspect_ratio=ASPECT_RATIO_16_9):
+        return self.size(tags, rating, aspect_ratio) < self.low_water
+
+    def add(self, tags, rating, posts, aspect_ratio=ASPECT_RATIO_16_9):
+        """Adds candidates to the pool, ignoring posts that are already in it."""
+        expires_at = time.monotonic() + self.ttl
+        with self.lock:
+            pool = self._live_entries(self._key(tags, rating, aspect_ratio))
+            for post in posts:
+                pool.setdefault(post['id'], (expires_at, post))
+
+    def page_count(self, tags, rating, aspect_ratio=ASPECT_RATIO_16_9):
+        """Returns how many result pages exist for a query, looking the count up at most once per POST_COUNT_TTL."""
+        key = self._key(tags, rating, aspect_ratio)
+        with self.lock:
+            cached = self.page_counts.get(key)
+        if cached and cached[0] > time.monotonic():
+            return cached[1]
+        post_count = fetch_post_count(self.http_client, build_search_tags(tags, rating, aspect_ratio, self.crop))
+        if post_count is None:
+            pages = 200 # Danbooru timed out counting; fall back to a fixed range.
+        else:
+            pages = min(DANBOORU_PAGE_LIMIT, math.ceil(post_count / POSTS_PER_PAGE))
+        with self.lock:
+            self.page_counts[key] = (time.monotonic() + POST_COUNT_TTL, pages)
+        return pages
+
+    def refill(self, tags, rating, aspect_ratio=ASPECT_RATIO_16_9):
+        """Fetches one more page from the API into the pool and returns how many candidates it added.
+
+        Posts that were already shown are left out. If HISTORY_STALE_PAGES pages in a row hold nothing new,
+        the query has probably been seen through, and the last page is used anyway so the rotation continues.
+        """
+        pages = self.page_count(tags, rating, aspect_ratio)
+        if pages == 0:
+            return 0
+        for attempt in range(HISTORY_STALE_PAGES):
+            posts = fetch_suitable_posts(self.http_client, tags, rating, random.randint(1, pages), aspect_ratio, self.crop)
+            metrics.count('pool_refills')
+            with self.lock:
+                if not posts:
+                    # The result count may have shrunk since it was cached; look it up again next time.
+                    self.page_counts.pop(self._key(tags, rating, aspect_ratio), None)
+            if self.history is None or not posts:
+                break
+            unseen = [post for post in posts if post['id'] not in self.history]
+            metrics.count('posts_already_shown', len(posts) - len(unseen))
+            if unseen or pages == 1 or attempt == HISTORY_STALE_PAGES - 1:
+                posts = unseen or posts
+                break
+        self.add(tags, rating, posts, aspect_ratio)
+        return len(posts)
+
+    def refill_if_low(self, tags, rating, aspect_ratio=ASPECT_RATIO_16_9):
+        """Refills the pool if it is below the low-water mark. Concurrent callers for the same query share one API call."""
+        key = self._key(tags, rating, aspect_ratio)
+        with self.lock:
+            refill_lock = self.refill_locks.setdefault(key, threading.Lock())
+        with refill_lock:
+            if self.needs_refill(tags, rating, aspect_ratio):
+                return self.refill(tags, rating, aspect_ratio)
+        return 0
+
+    def snapshot(self, limit=SNAPSHOT_CANDIDATES):
+        """Returns up to limit live candidates per query as [tags, rating, aspect ratio, posts] lists, for a warm start."""
+        with self.lock:
+            pools = [(key, self._live_entries(key)) for key in list(self.entries)]
+            return [[*key, [post for _, post in list(pool.values())[:limit]]] for key, pool in pools if pool]
+
+    def restore(self, candidates):
+        """Adds candidates saved by snapshot() back into the pool."""
+        for tags, rating, aspect_ratio, posts in candidates:
+            self.add(tags, rating, posts, aspect_ratio)
+
+    def take(self, tags, rating, aspect_ratio=ASPECT_RATIO_16_9, exclude=()):
+        """Removes and returns a random candidate that is not in exclude, or None if there is none."""
+        with self.lock:
+            pool = self._live_entries(self._key(tags, rating, aspect_ratio))
+            post_ids = [post_id for post_id in pool if post_id not in exclude]
+            if not post_ids:
+                return None
+            _, post = pool.pop(random.choice(post_ids))
+            return post
+
+
+# --- Playlists ---
+PlaylistEntry = collections.namedtuple('PlaylistEntry', ['tags', 'rating', 'weight'])
+
+def parse_playlist(text, default_rating=DEFAULT_RATING):
+    """Parses a playlist such as "genshin_impact 1girl weight:3; scenery rating:sensitive" into PlaylistEntry tuples.
+
+    Entries are separated by a ';' followed by whitespace or the end of the text, so tags that contain one,
+    such as ;d or ;), stay intact. rating: and weight: tokens apply to their own entry; entries without a
+    rating use default_rating. Plain tags without a separator make a one-entry playlist. Raises ValueError.
+    """
+    entries = []
+    for part in re.split(r";(?=\s|$)", text):
+        if not part.strip():
+            continue
+        tags, rating, weight = [], default_rating, 1
+        for token in part.split():
+            name, _, value = token.partition(':')
+            if name == 'weight':
+                if not value.isdigit() or int(value) < 1:
+                    raise ValueError(f"'{token}' is not a valid weight; use a whole number of at least 1.")
+                weight = int(value)
+            elif name == 'rating':
+                matches = [r for r in RATINGS if r == value or r[0] == value]
+                if not matches:
+                    raise ValueError(f"'{token}' is not a valid rating; use one of {', '.join(RATINGS)}.")
+                rating = matches[0]
+            else:
+                tags.append(token)
+        entries.append(PlaylistEntry(' '.join(tags), rating, weight))
+    return entries or [PlaylistEntry('', default_rating, 1)]
+
+
+class Playlist:
+    """Picks entries by smooth weighted round-robin: every entry is chosen in proportion to its weight, evenly
+    spread out, so none starves. Entries whose queries keep coming up empty are skipped with a growing backoff."""
+    def __init__(self, entries):
+        self.entries = list(entries)
+        self.current = [0] * len(self.entries)
+        self.failures = [0] * len(self.entries)
+        self.blocked_until = [0.0] * len(self.entries)
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def next(self):
+        """Returns the next entry to draw from, or None while every entry is backed off."""
+        with self.lock:
+            now = time.monotonic()
+            active = [i for i in range(len(self.entries)) if self.blocked_until[i] <= now]
+            if not active:
+                return None
+            for i in active:
+                self.current[i] += self.entries[i].weight
+            chosen = max(active, key=self.current.__getitem__)
+            self.current[chosen] -= sum(self.entries[i].weight for i in active)
+            return self.entries[chosen]
+
+    def report(self, entry, found):
+        """Records whether a refill for entry found anything, backing it off if not."""
+        with self.lock:
+            i = self.entries.index(entry)
+            if found:
+                self.failures[i] = 0
+                self.blocked_until[i] = 0.0
+            else:
+                self.blocked_until[i] = time.monotonic() + backoff_delay(self.failures[i], PLAYLIST_BACKOFF_BASE, PLAYLIST_BACKOFF_MAX)
+                self.failures[i] += 1
+
+
+# --- Image processing ---
+_numpy = False # Not imported yet; None once the import has failed
+
+def load_numpy():
+    """Imports NumPy on first use, so startup never pays for it. Returns None if it is not installed,
+    in which case near-duplicate detection is skipped and crops are centred."""
+    global _numpy
+    if _numpy is False:
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+        _numpy = numpy
+    return _numpy
+
+def is_valid_image(path):
+    """Returns True if the file at path can be decoded as an image."""
+    try:
+        with Image.open(path) as img:
+            img.verify()
+        return True
+    except Exception:
+        return False
+
+def crop_size(size, aspect_ratio):
+    """Returns the (width, height) of the largest window of aspect_ratio that fits in an image of size."""
+    width, height = size
+    return min(width, height * aspect_ratio), min(height, width / aspect_ratio)
+
+def choose_variant(post, screen_size, crop=False):
+    """Returns the smallest downloadable version of a post that still covers the screen, after cropping with crop.
+
+    Danbooru offers several sizes in media_asset.variants; the original is used when none of the smaller ones is big enough.
+    """
+    screen_width, screen_height = screen_size
+    original = {
+        'url': post['file_url'],
+        'width': post['image_width'],
+        'height': post['image_height'],
+        'file_ext': post['file_ext'],
+        'is_original': True,
+    }
+    best = original
+    for variant in (post.get('media_asset') or {}).get('variants', []):
+        if variant.get('type') == 'original' or variant.get('file_ext') not in ALLOWED_EXTENSIONS:
+            continue
+        width, height = variant.get('width', 0), variant.get('height', 0)
+        covered_width, covered_height = crop_size((width, height), screen_width / screen_height) if crop else (width, height)
+        if covered_width >= screen_width and covered_height >= screen_height and width * height < best['width'] * best['height']:
+            best = {'url': variant['url'], 'width': width, 'height': height, 'file_ext': variant['file_ext'], 'is_original': False}
+    return best
+
+def flatten_to_rgb(img):
+    """Converts an image to RGB, compositing any transparency onto black like the desktop would."""
+    if img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info):
+        img = img.convert('RGBA')
+        background = Image.new('RGB', img.size, 'black')
+        background.paste(img, mask=img.getchannel('A'))
+        return background
+    return img if img.mode == 'RGB' else img.convert('RGB')
+
+def decode_at_size(img, target_size):
+    """Decodes an opened image to RGB at target_size, using JPEG draft mode and Image.reduce before the final LANCZOS resample."""
+    if target_size[0] < img.width and target_size[1] < img.height:
+        img.draft('RGB', target_size) # Lets libjpeg decode at 1/2, 1/4 or 1/8 scale
+    rgb = flatten_to_rgb(img)
+    factor = min(rgb.width // target_size[0], rgb.height // target_size[1])
+    if factor >= 2:
+        rgb = rgb.reduce(factor)
+    if rgb.size != target_size:
+        rgb = rgb.resize(target_size, Image.Resampling.LANCZOS)
+    return rgb
+
+def crop_offset(img, aspect_ratio):
+    """Returns where the most interesting window of aspect_ratio starts along the axis an opened image is too long in,
+    as a fraction of that side.
+
+    Scored on a small grayscale copy: edge detail plus contrast against the image's mean, summed per column
+    (or row) so every window position is scored with one cumulative sum. Without NumPy the window is centred.
+    """
+    crop_width, crop_height = crop_size(img.size, aspect_ratio)
+    horizontal = crop_width < img.width
+    free = 1 - (crop_width / img.width if horizontal else crop_height / img.height)
+    np = load_numpy()
+    if np is None:
+        return free / 2
+    small = img.reduce(max(1, max(img.size) // CROP_ANALYSIS_SIZE)).convert('L')
+    gray = np.asarray(small, dtype=np.float32)
+    energy = np.abs(gray - gray.mean()) * CROP_CONTRAST_WEIGHT
+    energy[:-1] += np.abs(np.diff(gray, axis=0))
+    energy[:, :-1] += np.abs(np.diff(gray, axis=1))
+    profile = energy.sum(axis=0 if horizontal else 1)
+    window = max(1, min(len(profile), round(len(profile) * (1 - free))))
+    sums = np.concatenate(([0.0], np.cumsum(profile, dtype=np.float64)))
+    scores = sums[window:] - sums[:-window]
+    if len(scores) > 1:
+        distance = np.abs(np.linspace(-1, 1, len(scores)))
+        scores *= 1 - CROP_CENTER_BIAS * distance
+    return min(free, int(np.argmax(scores)) / len(profile))
+
+def crop_to_fit(img, screen_size):
+    """Decodes the screen-shaped window of an opened image chosen by crop_offset(), scaled to cover the screen but never enlarged.
+
+    The crop and the resample are a single Image.resize call with a box, after a JPEG draft decode at the smallest scale that still covers it.
+    """
+    aspect_ratio = screen_size[0] / screen_size[1]
+    crop_width, crop_height = crop_size(img.size, aspect_ratio)
+    scale = min(1, max(screen_size[0] / crop_width, screen_size[1] / crop_height))
+    target_size = (max(1, round(crop_width * scale)), max(1, round(crop_height * scale)))
+    with metrics.timer('decode'):
+        img.draft('RGB', (math.ceil(img.width * scale), math.ceil(img.height * scale)))
+        img.load()
+        rgb = flatten_to_rgb(img)
+    with metrics.timer('crop'):
+        # Measured again on the decoded image, which draft mode may have made smaller.
+        crop_width, crop_height = crop_size(rgb.size, aspect_ratio)
+        offset = crop_offset(rgb, aspect_ratio)
+        left = min(offset * rgb.width, rgb.width - crop_width) if crop_width < rgb.width else 0
+        top = min(offset * rgb.height, rgb.height - crop_height) if crop_height < rgb.height else 0
+        box = (left, top, left + crop_width, top + crop_height)
+        return rgb.resize(target_size, Image.Resampling.LANCZOS, box=box, reducing_gap=2.0)
+
+def fit_to_screen(path, dest_path, screen_size, crop=False):
+    """Writes the image at path to dest_path as a JPEG just large enough to cover the screen.
+
+    JPEGs that are already small enough are moved over untouched. Large images are shrunk with
+    the JPEG draft mode and Image.reduce before the final resample. With crop, images that are not
+    the screen's shape are cropped to it with crop_to_fit(). Returns the bytes written.
+    """
+    screen_width, screen_height = screen_size
+    with Image.open(path) as img:
+        if crop and abs(img.width / img.height - screen_width / screen_height) >= ASPECT_RATIO_TOLERANCE:
+            rgb = crop_to_fit(img, screen_size)
+            metrics.count('cropped')
+        else:
+            scale = max(screen_width / img.width, screen_height / img.height)
+            if scale >= 1 and img.format == 'JPEG':
+                img.close()
+                os.replace(path, dest_path)
+                return os.path.getsize(dest_path)
+
+            scale = min(scale, 1)
+            with metrics.timer('decode'):
+                rgb = decode_at_size(img, (max(1, round(img.width * scale)), max(1, round(img.height * scale))))
+        temp_path = f"{dest_path}.tmp"
+        with metrics.timer('encode_write'):
+            rgb.save(temp_path, 'JPEG', quality=WALLPAPER_JPEG_QUALITY, optimize=True)
+    os.replace(temp_path, dest_path)
+    if os.path.abspath(path) != os.path.abspath(dest_path):
+        os.remove(path)
+    return os.path.getsize(dest_path)
+
+
+# --- Monitor layout ---
+Monitor = collections.namedtuple('Monitor', ['x', 'y', 'width', 'height'])
+
+def monitor_signature(monitor):
+    """Identifies the size an image was fitted to for one monitor."""
+    return f"{monitor.width}x{monitor.height}"
+
+
+class MonitorLayout:
+    """The monitors the wallpaper spans, in desktop coordinates. Configured as text, so no OS probing is needed."""
+    def __init__(self, monitors):
+        if not monitors:
+            raise ValueError("A monitor layout needs at least one monitor.")
+        self.monitors = list(monitors)
+        self.origin = (min(m.x for m in self.monitors), min(m.y for m in self.monitors))
+        self.canvas_size = (
+            max(m.x + m.width for m in self.monitors) - self.origin[0],
+            max(m.y + m.height for m in self.monitors) - self.origin[1],
+        )
+
+    @classmethod
+    def parse(cls, spec, default_size=DEFAULT_SCREEN_SIZE):
+        """Parses a layout such as "1920x1080+0+0, 2560x1440+1920+0".
+
+        The +x+y offset may be left out, in which case the monitor is placed to the right of the
+        previous one. An empty spec means a single monitor of default_size.
+        """
+        if not spec.strip():
+            return cls([Monitor(0, 0, *default_size)])
+        monitors = []
+        next_x = 0
+        for part in spec.split(','):
+            match = re.fullmatch(r"\s*(\d+)x(\d+)(?:([+-]\d+)([+-]\d+))?\s*", part)
+            if not match:
+                raise ValueError(f"Invalid monitor '{part.strip()}'. Use WIDTHxHEIGHT+X+Y, e.g. 1920x1080+0+0.")
+            width, height = int(match.group(1)), int(match.group(2))
+            if width == 0 or height == 0:
+                raise ValueError(f"Invalid monitor '{part.strip()}': size must not be zero.")
+            x = int(match.group(3)) if match.group(3) else next_x
+            y = int(match.group(4)) if match.group(4) else 0
+            monitors.append(Monitor(x, y, width, height))
+            next_x = x + width
+        return cls(monitors)
+
+    @property
+    def is_spanned(self):
+        return len(self.monitors) > 1
+
+    @property
+    def signature(self):
+        """Identifies the size the final wallpaper is fitted to; a single monitor matches its own WxH."""
+        if not self.is_spanned:
+            return monitor_signature(self.monitors[0])
+        return ','.join(f"{m.width}x{m.height}{m.x:+d}{m.y:+d}" for m in self.monitors)
+
+
+class SpanCompositor:
+    """Pastes one image per monitor into a single canvas covering the whole layout.
+
+    The canvas is allocated once and reused for every change; only the monitor areas are ever
+    painted, so gaps between monitors stay black.
+    """
+    def __init__(self, layout):
+        self.layout = layout
+        self.canvas = Image.new('RGB', layout.canvas_size, 'black')
+
+    def compose(self, paths, dest_path):
+        """Composites the images at paths (one per monitor, in layout order) and writes the result to dest_path."""
+        origin_x, origin_y = self.layout.origin
+        for monitor, path in zip(self.layout.monitors, paths):
+            size = (monitor.width, monitor.height)
+            with Image.open(path) as tile:
+                if tile.size != size:
+                    tile = ImageOps.fit(flatten_to_rgb(tile), size, Image.Resampling.LANCZOS)
+                self.canvas.paste(tile, (monitor.x - origin_x, monitor.y - origin_y))
+        temp_path = f"{dest_path}.tmp"
+        self.canvas.save(temp_path, 'JPEG', quality=WALLPAPER_JPEG_QUALITY, optimize=True)
+        os.replace(temp_path, dest_path)
+        return os.path.getsize(dest_path)
+
+
+# --- Shown history ---
+def dhash(path):
+    """Returns the 64-bit difference hash of an image: one bit per horizontally adjacent pixel pair of a 9x8 grayscale thumbnail.
+
+    Near-identical images (recolours, with or without text) land a few bits apart. Returns None without NumPy.
+    """
+    np = load_numpy()
+    if np is None:
+        return None
+    with Image.open(path) as img:
+        img.draft('L', (64, 64))
+        pixels = np.asarray(img.convert('L').resize((9, 8), Image.Resampling.BILINEAR), dtype=np.int16)
+    bits = pixels[:, 1:] > pixels[:, :-1]
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count('1')
+
+
+class BloomFilter:
+    """Fixed-size set of integers with no false negatives and a small false positive rate."""
+    def __init__(self, bits=HISTORY_BLOOM_BITS, hashes=HISTORY_BLOOM_HASHES):
+        self.size = bits
+        self.hashes = hashes
+        self.bits = bytearray(bits // 8)
+        self.count = 0
+
+    def _positions(self, key):
+        # Double hashing on a 64-bit multiplicative mix of the key.
+        mixed = (key * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+        h1, h2 = mixed & 0xFFFFFFFF, (mixed >> 32) | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+
+class ShownHistory:
+    """Post IDs that were already shown, and dHashes of recent images, so the rotation avoids repeats and near-duplicates.
+
+    The last HISTORY_RECENT_SIZE IDs are kept exactly, in a ring buffer with a bitmap over post IDs for O(1) lookups.
+    Older IDs move into two rotating Bloom filters, so memory stays bounded however long the slideshow runs.
+    Image hashes are indexed by DHASH_BANDS bands: two hashes within DHASH_MAX_DISTANCE bits share at least one band.
+    """
+    def __init__(self, path=HISTORY_PATH, recent_size=HISTORY_RECENT_SIZE, hash_size=HISTORY_HASH_SIZE):
+        self.path = path
+        self.recent = array.array('I', bytes(4 * recent_size))
+        self.recent_count = 0 # Total IDs ever added to the ring; the next slot is recent_count % recent_size
+        self.bitmap = bytearray()
+        self.blooms = [BloomFilter(), BloomFilter()] # [current, previous]; previous is dropped when current fills up
+        self.hashes = array.array('Q', bytes(8 * hash_size))
+        self.hash_count = 0
+        self.bands = [{} for _ in range(DHASH_BANDS)] # band i -> {band value: set of hash slots}
+        self.dirty = False
+        self.saved_at = time.monotonic()
+        self.lock = threading.Lock()
+        self.load()
+
+    def _in_bitmap(self, post_id):
+        return post_id >> 3 < len(self.bitmap) and self.bitmap[post_id >> 3] & (1 << (post_id & 7))
+
+    def __contains__(self, post_id):
+        with self.lock:
+            return bool(self._in_bitmap(post_id)) or post_id in self.blooms[0] or post_id in self.blooms[1]
+
+    def __len__(self):
+        return min(self.recent_count, len(self.recent))
+
+    def _add(self, post_id):
+        if self._in_bitmap(post_id):
+            return
+        slot = self.recent_count % len(self.recent)
+        if self.recent_count >= len(self.recent):
+            evicted = self.recent[slot]
+            self.bitmap[evicted >> 3] &= ~(1 << (evicted & 7)) & 0xFF
+            if self.blooms[0].count >= HISTORY_BLOOM_CAPACITY:
+                self.blooms = [BloomFilter(), self.blooms[0]]
+            self.blooms[0].add(evicted)
+        if post_id >> 3 >= len(self.bitmap):
+            self.bitmap.extend(bytes((post_id >> 3) + 1 - len(self.bitmap)))
+        self.bitmap[post_id >> 3] |= 1 << (post_id & 7)
+        self.recent[slot] = post_id
+        self.recent_count += 1
+
+    def add(self, post_ids):
+        """Records posts as shown. Saved to disk at most every HISTORY_SAVE_INTERVAL seconds; call save() on exit."""
+        with self.lock:
+            for post_id in post_ids:
+                self._add(post_id)
+            self.dirty = True
+            save_due = time.monotonic() - self.saved_at >= HISTORY_SAVE_INTERVAL
+        if save_due:
+            self.save()
+
+    def _band_values(self, image_hash):
+        width = 64 // DHASH_BANDS
+        return [(image_hash >> (i * width)) & ((1 << width) - 1) for i in range(DHASH_BANDS)]
+
+    def is_near_duplicate(self, image_hash):
+        """Returns True if a recent image is within DHASH_MAX_DISTANCE bits of image_hash."""
+        with self.lock:
+            candidates = set()
+            for band, value in zip(self.bands, self._band_values(image_hash)):
+                candidates |= band.get(value, set())
+            return any(hamming_distance(self.hashes[slot], image_hash) <= DHASH_MAX_DISTANCE for slot in candidates)
+
+    def add_hash(self, image_hash):
+        with self.lock:
+            slot = self.hash_count % len(self.hashes)
+            if self.hash_count >= len(self.hashes):
+                for band, value in zip(self.bands, self._band_values(self.hashes[slot])):
+                    band[value].discard(slot)
+                    if not band[value]:
+                        del band[value]
+            self.hashes[slot] = image_hash
+            for band, value in zip(self.bands, self._band_values(image_hash)):
+                band.setdefault(value, set()).add(slot)
+            self.hash_count += 1
+            self.dirty = True
+
+    def _ordered(self, ring, count):
+        """Returns the live entries of a ring buffer, oldest first."""
+        if count <= len(ring):
+            return ring[:count]
+        slot = count % len(ring)
+        return ring[slot:] + ring[:slot]
+
+    def save(self):
+        """Writes the history atomically; does nothing if it has not changed."""
+        with self.lock:
+            if not self.dirty:
+                return
+            ids = self._ordered(self.recent, self.recent_count)
+            hashes = self._ordered(self.hashes, self.hash_count)
+            if sys.byteorder == 'big':
+                ids.byteswap()
+                hashes.byteswap()
+            header = struct.pack('<4sIIIII', HISTORY_MAGIC, len(ids), len(hashes), self.blooms[0].size, self.blooms[0].count, self.blooms[1].count)
+            data = b''.join([header, ids.tobytes(), hashes.tobytes(), self.blooms[0].bits, self.blooms[1].bits])
+            self.dirty = False
+            self.saved_at = time.monotonic()
+        temp_path = f"{self.path}.tmp"
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            with open(temp_path, 'wb') as f:
+                f.write(data)
+            os.replace(temp_path, self.path)
+        except OSError as e:
+            print(f"Could not save the wallpaper history: {e}")
+
+    def load(self):
+        """Reads the history saved by save(). A missing, corrupt or incompatible file starts an empty history."""
+        try:
+            with open(self.path, 'rb') as f:
+                data = f.read()
+            magic, id_count, hash_count, bloom_bits, bloom_count, previous_count = struct.unpack_from('<4sIIIII', data)
+            if magic != HISTORY_MAGIC or bloom_bits != HISTORY_BLOOM_BITS:
+                return
+            offset = struct.calcsize('<4sIIIII')
+            ids = array.array('I', data[offset:offset + 4 * id_count])
+            offset += 4 * id_count
+            hashes = array.array('Q', data[offset:offset + 8 * hash_count])
+            offset += 8 * hash_count
+            blooms = [BloomFilter(), BloomFilter()]
+            for bloom, count in zip(blooms, (bloom_count, previous_count)):
+                bloom.bits = bytearray(data[offset:offset + bloom_bits // 8])
+                bloom.count = count
+                offset += bloom_bits // 8
+            if len(ids) != id_count or len(hashes) != hash_count or any(len(bloom.bits) != bloom_bits // 8 for bloom in blooms):
+                return
+        except (OSError, struct.error):
+            return
+        if sys.byteorder == 'big':
+            ids.byteswap()
+            hashes.byteswap()
+        self.blooms = blooms
+        for post_id in ids:
+            self._add(post_id)
+        for image_hash in hashes:
+            self.add_hash(image_hash)
+        self.dirty = False
+
+
+# --- Local image cache ---
+class ImageCache:
+    """On-disk store of ready-to-use wallpapers keyed by the post's md5, evicted least-recently-used within a byte budget.
+
+    The index is a single JSON file kept in LRU order, so startup never has to scan the directory.
+    """
+    def __init__(self, cache_dir=CACHE_DIR, budget=CACHE_BUDGET):
+        self.cache_dir = cache_dir
+        self.budget = budget
+        self.index_path = os.path.join(cache_dir, "index.json")
+        self.entries = collections.OrderedDict() # key -> metadata, least recently used first
+        self.total_bytes = 0
+        self.pins = collections.Counter() # Keys that are queued or on screen and must not be evicted
+        self.lock = threading.RLock()
+        self.opened_at = time.time()
+        os.makedirs(cache_dir, exist_ok=True)
+        self._load_index()
+
+    def _load_index(self):
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                for key, entry in json.load(f):
+                    self.entries[key] = entry
+                    self.total_bytes += entry['size']
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            if os.path.exists(self.index_path):
+                print(f"Error reading image cache index, starting empty: {e}")
+            self.entries.clear()
+            self.total_bytes = 0
+
+    def _save_index(self):
+        temp_path = f"{self.index_path}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(list(self.entries.items()), f)
+        os.replace(temp_path, self.index_path)
+
+    @staticmethod
+    def key_for(post):
+        return post.get('md5') or f"post_{post['id']}"
+
+    def path_for(self, key):
+        return os.path.join(self.cache_dir, f"{key}.jpg")
+
+    def _item(self, key, entry):
+        return dict(entry, key=key, path=self.path_for(key))
+
+    def get(self, key):
+        """Returns the cached item for key and marks it as recently used, or None on a miss."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if not os.path.exists(self.path_for(key)):
+                self._forget(key)
+                self._save_index()
+                return None
+            self.entries.move_to_end(key)
+            self._save_index()
+            return self._item(key, entry)
+
+    def add(self, key, metadata):
+        """Registers the file already written at path_for(key) and evicts old entries if over budget."""
+        with self.lock:
+            if key in self.entries:
+                self.total_bytes -= self.entries[key]['size']
+            entry = dict(metadata, size=os.path.getsize(self.path_for(key)))
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            self.total_bytes += entry['size']
+            self._evict()
+            self._save_index()
+            return self._item(key, entry)
+
+    def mark_shown(self, key):
+        """Records that key was just set as the wallpaper, so last_shown() can find it after a restart."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return
+            entry['shown_at'] = time.time()
+            self.entries.move_to_end(key)
+            self._save_index()
+
+    def last_shown(self):
+        """Returns the item most recently set as the wallpaper, or None if none is left in the cache.
+
+        Queued wallpapers are added after the one on screen, so recency of use alone would pick one never shown.
+        """
+        with self.lock:
+            shown = [key for key, entry in self.entries.items() if 'shown_at' in entry]
+            for key in sorted(shown, key=lambda key: self.entries[key]['shown_at'], reverse=True):
+                if os.path.exists(self.path_for(key)):
+                    return self._item(key, self.entries[key])
+            return None
+
+    def next_offline(self, exclude=(), fit=None):
+        """Returns the least recently used item not in exclude and marks it used, so repeated calls rotate through the cache.
+
+        With fit, only items fitted to that screen or layout signature are considered.
+        """
+        with self.lock:
+            for key in list(self.entries):
+                if key in exclude or (fit and self.entries[key].get('fit') != fit):
+                    continue
+                if not os.path.exists(self.path_for(key)):
+                    self._forget(key)
+                    continue
+                self.entries.move_to_end(key)
+                self._save_index()
+                return self._item(key, self.entries[key])
+            return None
+
+    def pin(self, key):
+        with self.lock:
+            self.pins[key] += 1
+
+    def unpin(self, key):
+        with self.lock:
+            self.pins[key] -= 1
+            if self.pins[key] <= 0:
+                del self.pins[key]
+
+    def _forget(self, key):
+        entry = self.entries.pop(key)
+        self.total_bytes -= entry['size']
+
+    def _evict(self):
+        for key in list(self.entries):
+            if self.total_bytes <= self.budget:
+                break
+            if key in self.pins:
+                continue
+            self._forget(key)
+            try:
+                os.remove(self.path_for(key))
+            except OSError as e:
+                print(f"Error removing cached wallpaper: {e}")
+
+    def remove_stale_files(self):
+        """Deletes partial downloads left in the cache by crashed sessions and temp files older versions kept in the Pictures folder."""
+        for filename in os.listdir(self.cache_dir):
+            if filename.startswith("download_") or filename.endswith((".part", ".tmp")):
+                path = os.path.join(self.cache_dir, filename)
+                try:
+                    # Files written since the cache was opened belong to downloads still in progress.
+                    if os.path.getmtime(path) < self.opened_at:
+                        os.remove(path)
+                except OSError:
+                    pass
+        if os.path.exists(SAVED_WALLPAPERS_DIR):
+            for filename in os.listdir(SAVED_WALLPAPERS_DIR):
+                if filename.startswith(("temp_wallpaper_", "prefetch_wallpaper_")):
+                    try:
+                        os.remove(os.path.join(SAVED_WALLPAPERS_DIR, filename))
+                    except OSError:
+                        pass
+
+
+class PreviewCache:
+    """Screen-sized previews rendered on a background thread, kept in a small in-memory LRU and on disk."""
+    def __init__(self, cache_dir=PREVIEW_CACHE_DIR, memory_items=PREVIEW_MEMORY_ITEMS, disk_budget=PREVIEW_DISK_BUDGET):
+        self.disk_cache = ImageCache(cache_dir, disk_budget)
+        self.memory_items = memory_items
+        self.memory = collections.OrderedDict() # key -> PIL image
+        self.pending = {} # key -> callbacks waiting for the render
+        self.lock = threading.Lock()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+    @staticmethod
+    def key_for(path, size):
+        """Identifies a preview by the image file's path, size and modification time, plus the preview size."""
+        stat = os.stat(path)
+        identity = f"{os.path.abspath(path)}|{stat.st_size}|{stat.st_mtime_ns}|{size[0]}x{size[1]}"
+        return hashlib.md5(identity.encode('utf-8')).hexdigest()
+
+    def get(self, path, size):
+        """Returns the preview if it is already in memory, otherwise None. Never decodes anything."""
+        try:
+            key = self.key_for(path, size)
+        except OSError:
+            return None
+        with self.lock:
+            img = self.memory.get(key)
+            if img is not None:
+                self.memory.move_to_end(key)
+            return img
+
+    def request(self, path, size, callback=None):
+        """Renders the preview in the background if needed. callback(image or None) runs on the worker thread."""
+        try:
+            key = self.key_for(path, size)
+        except OSError:
+            if callback:
+                callback(None)
+            return
+        with self.lock:
+            img = self.memory.get(key)
+            if img is None:
+                already_pending = key in self.pending
+                self.pending.setdefault(key, [])
+                if callback:
+                    self.pending[key].append(callback)
+                if not already_pending:
+                    self.executor.submit(self._render, key, path, size)
+                return
+        if callback:
+            callback(img)
+
+    def _render(self, key, path, size):
+        img = None
+        try:
+            cached_item = self.disk_cache.get(key)
+            if cached_item:
+                with Image.open(cached_item['path']) as cached:
+                    img = cached.convert('RGB')
+            else:
+                with Image.open(path) as source:
+                    scale = min(size[0] / source.width, size[1] / source.height, 1)
+                    img = decode_at_size(source, (max(1, round(source.width * scale)), max(1, round(source.height * scale))))
+                    img.load()
+                img.save(self.disk_cache.path_for(key), 'JPEG', quality=PREVIEW_JPEG_QUALITY)
+                self.disk_cache.add(key, {})
+        except Exception as e:
+            print(f"Error rendering preview: {e}")
+        with self.lock:
+            if img is not None:
+                self.memory[key] = img
+                self.memory.move_to_end(key)
+                while len(self.memory) > self.memory_items:
+                    self.memory.popitem(last=False)
+            callbacks = self.pending.pop(key, [])
+        for callback in callbacks:
+            callback(img)
+
+
+class WallpaperPrefetcher:
+    """Background producer that keeps a bounded queue of downloaded wallpapers ready to apply.
+
+    tags may be a whole playlist (see parse_playlist); each entry draws from its own candidate pool.
+    """
+    def __init__(self, tags, rating, http_client, post_pool, image_cache, status_callback, layout=None, queue_size=PREFETCH_QUEUE_SIZE, disk_budget=PREFETCH_DISK_BUDGET, history=None, on_ready=None):
+        self.tags = tags
+        self.rating = rating
+        self.entries = parse_playlist(tags, rating)
+        self.layout = layout or MonitorLayout.parse("")
+        # One playlist per monitor shape, so an entry with no portrait images is not backed off for landscape screens.
+        self.playlists = {round(m.width / m.height, 2): Playlist(self.entries) for m in self.layout.monitors}
+        self.refill_executor = concurrent.futures.ThreadPoolExecutor(max_workers=min(PLAYLIST_REFILL_WORKERS, len(self.entries)))
+        self.refills = {} # (entry, aspect ratio) -> future of the refill in progress
+        self.refills_lock = threading.Lock()
+        self.compositor = SpanCompositor(self.layout) if self.layout.is_spanned else None
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(self.layout.monitors))
+        self.http_client = http_client
+        self.post_pool = post_pool
+        self.image_cache = image_cache
+        self.history = history
+        self.status_callback = status_callback
+        self.on_ready = on_ready # Called after a wallpaper joins the queue, from the fetcher thread
+        self.queue_size = queue_size
+        self.disk_budget = disk_budget
+        self.ready = []
+        self.queued_bytes = 0
+        self.last_taken_ids = set()
+        self.failures = 0 # Consecutive failed cycles, drives the backoff between them
+        self.offline = False
+        self.condition = threading.Condition()
+        self.is_running = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.is_running.set()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Stops the fetcher without waiting for a request in flight; the fetcher thread drops its result and exits.
+        Wallpapers that were never shown stay in the image cache for later."""
+        with self.condition:
+            self.is_running.clear()
+            self.condition.notify_all()
+        self.executor.shutdown(wait=False)
+        self.refill_executor.shutdown(wait=False, cancel_futures=True)
+        with self.condition:
+            for ready_item in self.ready:
+                self.image_cache.unpin(ready_item['key'])
+            self.ready.clear()
+            self.queued_bytes = 0
+
+    def restore(self, keys):
+        """Queues wallpapers an earlier session had ready, if they are still in the image cache and fit this layout.
+        Call before start(). Returns how many were queued."""
+        restored = 0
+        for key in keys:
+            if not self._has_room():
+                break
+            cached_item = self.image_cache.get(key)
+            if cached_item is None or cached_item.get('fit') != self.layout.signature:
+                continue
+            self.image_cache.pin(key)
+            with self.condition:
+                self.ready.append(dict(cached_item, downloaded_bytes=0, decode_ms=0.0))
+                self.queued_bytes += cached_item['size']
+            restored += 1
+        metrics.count('snapshot_restored', restored)
+        return restored
+
+    def pool_size(self):
+        """Returns how many candidates are pooled for the main monitor across all playlist entries."""
+        monitor = self.layout.monitors[0]
+        return sum(self.post_pool.size(entry.tags, entry.rating, monitor.width / monitor.height) for entry in set(self.entries))
+
+    def depth(self):
+        """Returns the number of wallpapers currently waiting in the queue."""
+        with self.condition:
+            return len(self.ready)
+
+    def get(self, timeout=None, until_offline=False):
+        """Pops the next ready wallpaper, or returns None if none is ready within timeout.
+
+        With until_offline, also gives up as soon as the fetcher cannot reach Danbooru.
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: self.ready or not self.is_running.is_set() or (until_offline and self.offline), timeout)
+            if not self.ready:
+                return None
+            ready_item = self.ready.pop(0)
+            self.queued_bytes -= ready_item['size']
+            self.last_taken_ids = set(ready_item['post_ids'])
+            self.condition.notify_all()
+            return ready_item
+
+    def _has_room(self):
+        return len(self.ready) < self.queue_size and self.queued_bytes < self.disk_budget
+
+    def _sleep(self, seconds):
+        """Waits for the given number of seconds, returning early if the fetcher is stopped."""
+        with self.condition:
+            self.condition.wait_for(lambda: not self.is_running.is_set(), seconds)
+
+    def _report(self, message):
+        # Only surface progress while the consumer is actually waiting on us.
+        if not self.ready:
+            self.status_callback(message)
+
+    def _run(self):
+        while self.is_running.is_set():
+            with self.condition:
+                self.condition.wait_for(lambda: self._has_room() or not self.is_running.is_set())
+            if not self.is_running.is_set(): break
+            try:
+                with metrics.timer('prefetch'):
+                    ready_item = self._fetch_next()
+                self.failures = 0
+                self.offline = False
+                if ready_item is None:
+                    self._sleep(5)
+                    continue
+                with self.condition:
+                    if not self.is_running.is_set():
+                        self.image_cache.unpin(ready_item['key'])
+                        break
+                    self.ready.append(ready_item)
+                    self.queued_bytes += ready_item['size']
+                    self.condition.notify_all()
+                if self.on_ready:
+                    self.on_ready()
+            except requests.exceptions.HTTPError as e:
+                metrics.count('prefetch_errors')
+                if e.response is not None and e.response.status_code in RETRYABLE_STATUS_CODES:
+                    self._go_offline() # Danbooru itself is down or throttling us
+                delay = self._failure_delay(parse_retry_after(e.response))
+                self.status_callback(f"HTTP Error: {e.response.status_code}. Retrying in {delay:.0f}s...")
+                self._sleep(delay)
+            except requests.exceptions.RequestException as e:
+                metrics.count('prefetch_errors')
+                self._go_offline()
+                delay = self._failure_delay()
+                self.status_callback(f"Network Error. Check connection. Retrying in {delay:.0f}s...")
+                self._sleep(delay)
+            except Exception as e:
+                metrics.count('prefetch_errors')
+                delay = self._failure_delay()
+                self.status_callback(f"An unexpected error occurred: {e}. Retrying in {delay:.0f}s...")
+                self._sleep(delay)
+
+    def _go_offline(self):
+        with self.condition:
+            self.offline = True
+            self.condition.notify_all() # Lets a waiting consumer fall back to the image cache
+
+    def _failure_delay(self, retry_after=None):
+        """Returns how long to wait after a failed cycle, growing with each consecutive failure."""
+        delay = backoff_delay(self.failures, FETCH_BACKOFF_BASE, FETCH_BACKOFF_MAX)
+        self.failures += 1
+        return max(delay, retry_after or 0)
+
+    def _fetch_next(self):
+        """Prepares the next wallpaper, one image per monitor. Returns None if nothing usable was found."""
+        with self.condition:
+            excluded_ids = {post_id for ready_item in self.ready for post_id in ready_item['post_ids']}
+            excluded_ids |= self.last_taken_ids
+        if not self.layout.is_spanned:
+            return self._fetch_for_monitor(self.layout.monitors[0], excluded_ids)
+
+        # Monitors are fetched concurrently, so a spanned change costs about as much as a single one.
+        futures = [self.executor.submit(self._fetch_for_monitor, monitor, excluded_ids) for monitor in self.layout.monitors]
+        tiles = []
+        error = None
+        for future in futures:
+            try:
+                tiles.append(future.result())
+            except Exception as e:
+                error = error or e
+        try:
+            if error:
+                raise error
+            if any(tile is None for tile in tiles):
+                return None
+            return self._compose(tiles)
+        finally:
+            for tile in tiles:
+                if tile:
+                    self.image_cache.unpin(tile['key'])
+
+    def _compose(self, tiles):
+        """Composites per-monitor images into one spanned wallpaper in the image cache."""
+        key = "span_" + hashlib.md5('|'.join([self.layout.signature] + [tile['key'] for tile in tiles]).encode('utf-8')).hexdigest()
+        self.image_cache.pin(key)
+        try:
+            compose_start = time.perf_counter()
+            self.compositor.compose([tile['path'] for tile in tiles], self.image_cache.path_for(key))
+            compose_ms = (time.perf_counter() - compose_start) * 1000
+            metrics.observe('compose', compose_ms / 1000)
+            cached_item = self.image_cache.add(key, {
+                'post_id': tiles[0]['post_id'],
+                'post_ids': [post_id for tile in tiles for post_id in tile['post_ids']],
+                'image_url': tiles[0]['image_url'],
+                'post_url': tiles[0]['post_url'],
+                'fit': self.layout.signature,
+            })
+        except BaseException:
+            self.image_cache.unpin(key)
+            raise
+        return dict(
+            cached_item,
+            downloaded_bytes=sum(tile['downloaded_bytes'] for tile in tiles),
+            decode_ms=sum(tile['decode_ms'] for tile in tiles) + compose_ms,
+        )
+
+    def _refill(self, entry, aspect_ratio, playlist):
+        """Worker: refills one entry's pool and reports to the playlist whether the query found anything."""
+        try:
+            self.post_pool.refill_if_low(entry.tags, entry.rating, aspect_ratio)
+        except requests.exceptions.HTTPError as e:
+            if e.response is None or e.response.status_code not in RETRYABLE_STATUS_CODES:
+                # A query Danbooru rejects (e.g. too many tags) will not start working by itself.
+                playlist.report(entry, False)
+            raise
+        playlist.report(entry, self.post_pool.size(entry.tags, entry.rating, aspect_ratio) > 0)
+
+    def _request_refill(self, entry, aspect_ratio, playlist):
+        """Starts refilling an entry's pool in the background if it is running low. Returns the refill's future, or None."""
+        if not self.post_pool.needs_refill(entry.tags, entry.rating, aspect_ratio):
+            return None
+        key = (entry, round(aspect_ratio, 2))
+        with self.refills_lock:
+            future = self.refills.get(key)
+            if future is None or future.done():
+                future = self.refills[key] = self.refill_executor.submit(self._refill, entry, aspect_ratio, playlist)
+        return future
+
+    def _take_post(self, aspect_ratio, excluded_ids):
+        """Takes a candidate from the playlist. Empty pools are refilled concurrently, and the first entry to come back
+        with candidates is used, so a slow or empty query does not hold up the others."""
+        playlist = self.playlists[round(aspect_ratio, 2)]
+        pending = []
+        for _ in range(len(playlist)):
+            entry = playlist.next()
+            if entry is None:
+                break
+            future = self._request_refill(entry, aspect_ratio, playlist)
+            post = self.post_pool.take(entry.tags, entry.rating, aspect_ratio, exclude=excluded_ids)
+            if post:
+                return post
+            if future and all(future is not f for _, f in pending):
+                pending.append((entry, future))
+
+        if pending:
+            self._report("Fetching new image list...")
+        error = None
+        while pending:
+            done, _ = concurrent.futures.wait([future for _, future in pending], return_when=concurrent.futures.FIRST_COMPLETED)
+            for entry, future in [p for p in pending if p[1] in done]:
+                pending.remove((entry, future))
+                if future.cancelled():
+                    continue
+                if future.exception():
+                    error = error or future.exception()
+                    continue
+                post = self.post_pool.take(entry.tags, entry.rating, aspect_ratio, exclude=excluded_ids)
+                if post:
+                    return post
+        if error:
+            raise error # Nothing usable and at least one query failed: let the fetch loop back off or go offline
+        return None
+
+    def _fetch_for_monitor(self, monitor, excluded_ids):
+        """Takes a post shaped like the monitor from the playlist and makes sure it is in the image cache, fitted to that monitor."""
+        aspect_ratio = monitor.width / monitor.height
+        excluded_ids = set(excluded_ids)
+        for _ in range(PREFETCH_ATTEMPTS):
+            post = self._take_post(aspect_ratio, excluded_ids)
+            if post is None:
+                self._report("No suitable images found on this page. Retrying...")
+                return None
+
+            metadata = {
+                'post_id': post['id'],
+                'post_ids': [post['id']],
+                'image_url': post['file_url'],
+                'post_url': f"{self.http_client.base_url}/posts/{post['id']}",
+                'fit': monitor_signature(monitor),
+            }
+            key = ImageCache.key_for(post)
+            self.image_cache.pin(key)
+            cached_item = self.image_cache.get(key)
+            if cached_item and cached_item.get('fit') == metadata['fit']:
+                metrics.count('image_cache_hits')
+                return dict(cached_item, downloaded_bytes=0, decode_ms=0.0)
+            try:
+                ready_item = self._download(post, key, metadata, (monitor.width, monitor.height))
+            except BaseException:
+                self.image_cache.unpin(key)
+                raise
+            if ready_item is not None:
+                return ready_item
+            # Unusable or a near-duplicate; try another candidate straight away.
+            self.image_cache.unpin(key)
+            excluded_ids.add(post['id'])
+        return None
+
+    def _download(self, post, key, metadata, screen_size):
+        """Downloads and fits a post into the image cache. Returns None if the file turned out to be unusable."""
+        variant = choose_variant(post, screen_size, self.post_pool.crop)
+        self._report(f"Downloading: {os.path.basename(variant['url'])}")
+        download_path = os.path.join(self.image_cache.cache_dir, f"download_{post['id']}.{variant['file_ext']}")
+        download_start = time.perf_counter()
+        try:
+            # Only the original has a known size and md5 to check against.
+            if variant['is_original']:
+                downloaded_bytes = self.http_client.download(variant['url'], download_path, post.get('file_size'), post.get('md5'))
+            else:
+                downloaded_bytes = self.http_client.download(variant['url'], download_path)
+        except DownloadError as e:
+            metrics.count('download_rejected')
+            self._report(f"Skipping post {post['id']}: {e}")
+            return None
+        metrics.observe('download', time.perf_counter() - download_start)
+        if not is_valid_image(download_path):
+            metrics.count('invalid_images')
+            os.remove(download_path)
+            return None
+
+        decode_start = time.perf_counter()
+        fit_to_screen(download_path, self.image_cache.path_for(key), screen_size, self.post_pool.crop)
+        decode_ms = (time.perf_counter() - decode_start) * 1000
+        metrics.observe('fit', decode_ms / 1000)
+        if self.history is not None and load_numpy() is not None:
+            with metrics.timer('dhash'):
+                image_hash = dhash(self.image_cache.path_for(key))
+            if self.history.is_near_duplicate(image_hash):
+                metrics.count('near_duplicates')
+                self._report(f"Skipping post {post['id']}: looks like one shown recently.")
+                self.history.add([post['id']]) # Never download it again
+                os.remove(self.image_cache.path_for(key))
+                return None
+            self.history.add_hash(image_hash)
+        cached_item = self.image_cache.add(key, metadata)
+        return dict(cached_item, downloaded_bytes=downloaded_bytes, decode_ms=decode_ms)
+
+
+# --- Wallpaper library ---
+def clone_file(source, dest):
+    """Creates dest with the contents of source, sharing the data instead of copying it where the filesystem allows:
+    a reflink (copy-on-write clone), then a hard link, then a plain copy. Returns the method that worked.
+
+    The image cache only ever replaces files, never rewrites them in place, so a hard link never changes under the library.
+    """
+    if sys.platform.startswith('linux'):
+        import fcntl
+        try:
+            with open(source, 'rb') as src, open(dest, 'wb') as dst:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            return 'reflink'
+        except OSError:
+            with contextlib.suppress(OSError):
+                os.remove(dest)
+    try:
+        os.link(source, dest)
+        return 'hardlink'
+    except OSError:
+        pass
+    shutil.copyfile(source, dest)
+    return 'copy'
+
+
+class WallpaperLibrary:
+    """Saved wallpapers in the Pictures folder, indexed in SQLite by md5 with their post ID, tags, size and source.
+
+    Entries are dicts shaped like the slideshow's wallpaper items (key, path, post_ids, post_url, image_url),
+    so a saved wallpaper can be shown again exactly like a freshly downloaded one.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS wallpapers (
+            id INTEGER PRIMARY KEY,
+            md5 TEXT NOT NULL UNIQUE,
+            post_id INTEGER,
+            tags TEXT NOT NULL DEFAULT '',
+            width INTEGER,
+            height INTEGER,
+            post_url TEXT NOT NULL DEFAULT '',
+            image_url TEXT NOT NULL DEFAULT '',
+            filename TEXT NOT NULL,
+            saved_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS wallpapers_post_id ON wallpapers (post_id);
+    """
+
+    def __init__(self, library_dir=SAVED_WALLPAPERS_DIR, db_path=LIBRARY_DB_PATH):
+        self.library_dir = library_dir
+        os.makedirs(library_dir, exist_ok=True)
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.lock = threading.Lock()
+        with self.lock, self.db:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            is_new = self.db.execute("SELECT name FROM sqlite_master WHERE name = 'wallpapers'").fetchone() is None
+            self.db.executescript(self.SCHEMA)
+        if is_new:
+            self.import_folder()
+
+    def _entry(self, row):
+        entry = dict(row)
+        entry['key'] = entry['md5']
+        entry['path'] = os.path.join(self.library_dir, entry['filename'])
+        entry['post_ids'] = [entry['post_id']] if entry['post_id'] else []
+        return entry
+
+    def import_folder(self):
+        """Indexes images saved by older versions, which kept no metadata; the file name is all there is to go on."""
+        rows = []
+        with os.scandir(self.library_dir) as files:
+            for file in files:
+                name, ext = os.path.splitext(file.name)
+                if file.is_file() and ext.lower().lstrip('.') in ALLOWED_EXTENSIONS and not name.startswith(("temp_wallpaper_", "prefetch_wallpaper_")):
+                    rows.append((name, file.name, file.stat().st_mtime))
+        with self.lock, self.db:
+            self.db.executemany("INSERT OR IGNORE INTO wallpapers (md5, filename, saved_at) VALUES (?, ?, ?)", rows)
+        return len(rows)
+
+    def find(self, key):
+        with self.lock:
+            row = self.db.execute("SELECT * FROM wallpapers WHERE md5 = ?", (key,)).fetchone()
+        return self._entry(row) if row else None
+
+    def count(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM wallpapers").fetchone()[0]
+
+    def page(self, offset, limit):
+        """Returns up to limit entries, newest first, starting at offset."""
+        with self.lock:
+            rows = self.db.execute("SELECT * FROM wallpapers ORDER BY id DESC LIMIT ? OFFSET ?", (limit, offset)).fetchall()
+        return [self._entry(row) for row in rows]
+
+    def save(self, item, http_client=None):
+        """Adds a wallpaper from the image cache to the library. Returns (entry, created); created is False if it was already saved.
+
+        With an http_client the post's tags are looked up on Danbooru; without one, or offline, it is saved without them.
+        """
+        key = item['key']
+        entry = self.find(key)
+        if entry and os.path.exists(entry['path']):
+            return entry, False
+
+        filename = f"{key}.jpg"
+        path = os.path.join(self.library_dir, filename)
+        if not os.path.exists(path):
+            method = clone_file(item['path'], path)
+            metrics.count(f'library_saves_{method}')
+        with Image.open(path) as img:
+            width, height = img.size
+        post_id = item.get('post_id')
+        tags = ""
+        if http_client and post_id:
+            try:
+                tags = fetch_post_tags(http_client, post_id)
+            except Exception as e:
+                print(f"Could not fetch tags for post {post_id}: {e}")
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO wallpapers (md5, post_id, tags, width, height, post_url, image_url, filename, saved_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (key, post_id, tags, width, height, item.get('post_url', ""), item.get('image_url', ""), filename, time.time()))
+        return self.find(key), True
+
+
+class ThumbnailCache:
+    """Library thumbnails rendered on a background thread and kept on disk and in a memory LRU.
+
+    Requests are served newest first and ones that scrolled out of view can be dropped with retain(), so a fast
+    scroll through a large library only ever decodes what ends up on screen.
+    """
+    def __init__(self, cache_dir=THUMBNAIL_DIR, size=THUMBNAIL_SIZE, memory_items=THUMBNAIL_MEMORY_ITEMS):
+        self.cache_dir = cache_dir
+        self.size = size
+        self.memory_items = memory_items
+        self.memory = collections.OrderedDict() # key -> PIL image
+        self.pending = collections.OrderedDict() # key -> (source path, callbacks), newest last
+        self.lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)
+        self.worker = None
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def path_for(self, key):
+        return os.path.join(self.cache_dir, f"{key}_{self.size[0]}x{self.size[1]}.jpg")
+
+    def get(self, key):
+        """Returns the thumbnail if it is in memory, otherwise None. Never decodes anything."""
+        with self.lock:
+            img = self.memory.get(key)
+            if img is not None:
+                self.memory.move_to_end(key)
+            return img
+
+    def request(self, key, source_path, callback):
+        """Renders the thumbnail in the background; callback(image or None) runs on the worker thread."""
+        with self.condition:
+            _, callbacks = self.pending.pop(key, (None, []))
+            callbacks.append(callback)
+            self.pending[key] = (source_path, callbacks)
+            if self.worker is None:
+                self.worker = threading.Thread(target=self._run, daemon=True)
+                self.worker.start()
+            self.condition.notify()
+
+    def retain(self, keys):
+        """Drops pending requests for anything not in keys, e.g. rows that scrolled out of view."""
+        with self.lock:
+            for key in [key for key in self.pending if key not in keys]:
+                del self.pending[key]
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                key, (source_path, callbacks) = self.pending.popitem(last=True)
+            img = self._render(key, source_path)
+            with self.lock:
+                if img is not None:
+                    self.memory[key] = img
+                    while len(self.memory) > self.memory_items:
+                        self.memory.popitem(last=False)
+            for callback in callbacks:
+                callback(img)
+
+    def _render(self, key, source_path):
+        thumbnail_path = self.path_for(key)
+        try:
+            with Image.open(thumbnail_path) as cached:
+                return cached.convert('RGB')
+        except OSError:
+            pass
+        try:
+            with metrics.timer('thumbnail'):
+                with Image.open(source_path) as source:
+                    source.draft('RGB', (self.size[0] * 2, self.size[1] * 2))
+                    img = ImageOps.fit(flatten_to_rgb(source), self.size, Image.Resampling.BILINEAR)
+                temp_path = f"{thumbnail_path}.tmp"
+                img.save(temp_path, 'JPEG', quality=THUMBNAIL_JPEG_QUALITY)
+                os.replace(temp_path, thumbnail_path)
+            return img
+        except Exception as e:
+            print(f"Error rendering thumbnail: {e}")
+            return None
+
+
+# --- Scheduling ---
+class Scheduler:
+    """Decides when the next wallpaper change is due.
+
+    The slideshow thread sleeps on a condition until a monotonic deadline. Stop, pause, resume,
+    skip and interval changes notify it, so it wakes once per change instead of once a second.
+    Deadlines follow a fixed grid, so time spent fetching does not push later changes back.
+    """
+    def __init__(self, interval, align=False, resume_at=None):
+        self.interval = interval
+        self.align = align
+        self.condition = threading.Condition()
+        self.deadline = time.monotonic() # The first change is due straight away
+        self.resume_at = resume_at # Monotonic time a restored session's next change was due; kept for the change after the first
+        self.remaining = None # Seconds that were left until the deadline when paused; None while running
+        self.skip_requested = False
+        self.forced = False # The current change was requested with skip(), so it goes ahead even while paused
+        self.stopped = False
+        self.on_grid = False # The pending deadline is a clock boundary picked in align mode
+
+    @property
+    def paused(self):
+        return self.remaining is not None
+
+    def _next_deadline(self, previous, after_boundary=False):
+        now = time.monotonic()
+        if self.align:
+            # Line up with the local clock, e.g. an interval of 3600 changes on the hour.
+            local_time = time.time() + time.localtime().tm_gmtoff
+            wait = self.interval - local_time % self.interval
+            if after_boundary and wait < self.interval / 2:
+                # The wall clock reads slightly behind the boundary just served (NTP slewing, a QPC-based
+                # monotonic clock), so that same boundary still looks ahead; never fire twice for it.
+                wait += self.interval
+            self.on_grid = True
+            return now + wait
+        deadline = previous + self.interval
+        # Only leave the grid if a whole interval was missed, e.g. while offline; never fire twice in a row.
+        return deadline if deadline > now else now + self.interval
+
+    def wait(self):
+        """Blocks until the next change is due and schedules the one after it. Returns False once stopped."""
+        with self.condition:
+            while not self.stopped and not self.skip_requested:
+                if self.remaining is None:
+                    timeout = self.deadline - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    self.condition.wait(timeout)
+                else:
+                    self.condition.wait()
+            if self.stopped:
+                return False
+            self.forced = self.skip_requested
+            self.skip_requested = False
+            self.deadline = self._next_deadline(time.monotonic() if self.forced else self.deadline, self.on_grid and not self.forced)
+            if self.resume_at is not None:
+                # Back on the previous session's grid, unless that deadline has already passed.
+                if self.resume_at > time.monotonic():
+                    self.deadline = min(self.deadline, self.resume_at)
+                self.resume_at = None
+            if self.remaining is not None:
+                self.remaining = self.deadline - time.monotonic()
+            return True
+
+    def hold(self):
+        """Called once the next wallpaper is ready: blocks while paused, unless the change was a skip. Returns False once stopped."""
+        with self.condition:
+            self.condition.wait_for(lambda: self.stopped or self.remaining is None or self.forced or self.skip_requested)
+            # A skip pressed while this change was being prepared is satisfied by it.
+            self.skip_requested = False
+            return not self.stopped
+
+    def pause(self):
+        with self.condition:
+            if self.remaining is None:
+                self.remaining = max(0.0, self.deadline - time.monotonic())
+                self.condition.notify_all()
+
+    def resume(self):
+        with self.condition:
+            if self.remaining is not None:
+                self.deadline = time.monotonic() + self.remaining
+                self.remaining = None
+                self.condition.notify_all()
+
+    def next_change_at(self):
+        """Returns the wall-clock time the next change is due, counting a pause as frozen at its remaining time."""
+        with self.condition:
+            remaining = self.remaining if self.remaining is not None else self.deadline - time.monotonic()
+            return time.time() + remaining
+
+    def skip(self):
+        """Makes the next change happen now, even while paused."""
+        with self.condition:
+            self.skip_requested = True
+            self.condition.notify_all()
+
+    def set_interval(self, interval):
+        """Changes the interval, moving the pending deadline as if it had been scheduled with the new one."""
+        with self.condition:
+            now = time.monotonic()
+            if self.align:
+                self.interval = interval
+                self.deadline = self._next_deadline(now)
+            else:
+                self.deadline = max(now, self.deadline - self.interval + interval)
+                self.interval = interval
+            if self.remaining is not None:
+                self.remaining = self.deadline - now
+            self.condition.notify_all()
+
+    def retry_in(self, seconds):
+        """Moves the next change to `seconds` from now, e.g. after an unexpected error."""
+        with self.condition:
+            self.deadline = time.monotonic() + seconds
+            self.on_grid = False
+            self.condition.notify_all()
+
+    def seconds_until_next(self):
+        with self.condition:
+            if self.remaining is not None:
+                return self.remaining
+            return max(0.0, self.deadline - time.monotonic())
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+
+
+# --- Warm start ---
+def write_snapshot(snapshot, path=SNAPSHOT_PATH):
+    """Writes a warm-start snapshot atomically, so a crash mid-write leaves the previous one intact."""
+    temp_path = f"{path}.tmp"
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(snapshot, f, separators=(',', ':'))
+        os.replace(temp_path, path)
+    except OSError as e:
+        print(f"Could not save the warm-start snapshot: {e}")
+
+def load_snapshot(path=SNAPSHOT_PATH):
+    """Returns the snapshot the last session saved, or None if there is no usable one."""
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            snapshot = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(snapshot, dict) or snapshot.get('version') != SNAPSHOT_VERSION:
+        return None
+    return snapshot
+
+
+# --- Slideshow engine ---
+class SlideshowEngine:
+    """The slideshow without any GUI: owns the prefetcher and the change timer, and applies wallpapers through a backend.
+
+    on_status(message) and on_wallpaper(item) are called from worker threads.
+    """
+    def __init__(self, backend=None, http_client=None, image_cache=None, history=None, snapshot_path=SNAPSHOT_PATH, on_status=print, on_wallpaper=None):
+        self.backend = backend or default_backend() or WindowsBackend()
+        self.http_client = http_client or HttpClient()
+        self.history = history if history is not None else ShownHistory()
+        self.post_pool = PostPool(self.http_client, history=self.history)
+        self.image_cache = image_cache or ImageCache()
+        self.snapshot_path = snapshot_path
+        self.snapshot_lock = threading.Lock()
+        self.on_status = on_status
+        self.on_wallpaper = on_wallpaper
+        self.interval = DEFAULT_INTERVAL
+        self.align = False
+        self.crop = False
+        self.prefetcher = None
+        self.scheduler = None
+        self.slideshow_thread = None
+        self.current_cache_key = None
+        self.current_item = None
+        self.current_image_path = None
+        self.current_image_url = ""
+        self.current_post_url = ""
+
+    def update_status(self, message):
+        if self.on_status:
+            self.on_status(message)
+
+    def is_active(self):
+        return self.slideshow_thread is not None and self.slideshow_thread.is_alive()
+
+    def start(self, tags, rating, interval, layout=None, align=False, crop=False, snapshot=None):
+        """Starts prefetching and the change timer. With align, changes line up with the clock; with crop, posts of
+        other shapes are cropped to fit the screen instead of skipped. Does nothing if already running.
+
+        A snapshot from load_snapshot() taken with the same settings restores the queued wallpapers, pooled
+        candidates and change rhythm of that session, so the first change needs no network at all.
+        """
+        if self.is_active():
+            return
+        self.interval = interval
+        self.align = align
+        self.crop = crop
+        if self.post_pool.crop != crop:
+            # Candidates and page counts were filtered for the other mode.
+            self.post_pool = PostPool(self.http_client, history=self.history, crop=crop)
+        self.prefetcher = WallpaperPrefetcher(tags, rating, self.http_client, self.post_pool, self.image_cache, self.update_status, layout,
+                                              history=self.history, on_ready=self.save_snapshot)
+        resume_at = None
+        if snapshot and snapshot['settings'] == self.settings():
+            with metrics.timer('snapshot_restore'):
+                if time.time() - snapshot['saved_at'] < POST_POOL_TTL:
+                    self.post_pool.restore(snapshot['candidates'])
+                self.prefetcher.restore(snapshot['ready'])
+            if not align:
+                resume_at = time.monotonic() + snapshot['next_change_at'] - time.time()
+        self.scheduler = Scheduler(interval, align, resume_at)
+        self.prefetcher.start()
+        self.slideshow_thread = threading.Thread(target=self.wallpaper_loop, daemon=True)
+        self.slideshow_thread.start()
+
+    def settings(self):
+        """Returns what the running slideshow was started with, as stored in snapshots."""
+        return {
+            'tags': self.prefetcher.tags,
+            'rating': self.prefetcher.rating,
+            'interval': self.interval,
+            'layout': self.prefetcher.layout.signature,
+            'align': self.align,
+            'crop': self.crop,
+        }
+
+    def snapshot(self):
+        """Returns what a later start needs to pick up where this session is: its settings, the queued wallpapers
+        (as image cache keys), a few pooled candidates per query and when the next change is due."""
+        with self.prefetcher.condition:
+            ready_keys = [ready_item['key'] for ready_item in self.prefetcher.ready]
+        return {
+            'version': SNAPSHOT_VERSION,
+            'saved_at': time.time(),
+            'settings': self.settings(),
+            'ready': ready_keys,
+            'next_change_at': self.scheduler.next_change_at(),
+            'candidates': self.post_pool.snapshot(),
+        }
+
+    def save_snapshot(self):
+        """Writes the warm-start snapshot; called after every change and whenever the queue grows, and by stop()."""
+        if self.scheduler is None or self.scheduler.stopped:
+            return # stop() already wrote the final one
+        with self.snapshot_lock:
+            write_snapshot(self.snapshot(), self.snapshot_path)
+
+    def stop(self, timeout=None):
+        """Stops the slideshow, saving a warm-start snapshot first. With a timeout, also waits up to that long for the loop thread to finish."""
+        already_stopped = self.scheduler is None or self.scheduler.stopped
+        if self.scheduler:
+            self.scheduler.stop()
+        if self.prefetcher and not already_stopped:
+            # Only the first stop sees the queue; later ones would overwrite the snapshot with an empty one.
+            with self.snapshot_lock:
+                write_snapshot(self.snapshot(), self.snapshot_path)
+            self.prefetcher.stop()
+        self.history.save()
+        if timeout is not None and self.is_active() and self.slideshow_thread is not threading.current_thread():
+            self.slideshow_thread.join(timeout=timeout)
+
+    def pause(self):
+        if self.scheduler:
+            self.scheduler.pause()
+
+    def resume(self):
+        if self.scheduler:
+            self.scheduler.resume()
+
+    def skip(self):
+        """Shows the next wallpaper now instead of waiting for the interval."""
+        if self.scheduler:
+            self.scheduler.skip()
+
+    def set_interval(self, interval):
+        self.interval = interval
+        if self.scheduler:
+            self.scheduler.set_interval(interval)
+
+    def show_saved(self, entry):
+        """Sets a wallpaper from the library straight from its local file, without touching the network.
+
+        A running slideshow carries on from it at its next change. Returns False if the backend failed.
+        """
+        if not self.backend.set_wallpaper(entry['path']):
+            self.update_status(f"Error: Failed to set wallpaper via {self.backend.name}.")
+            return False
+        metrics.count('library_wallpapers_set')
+        self.history.add(entry['post_ids'])
+        self.current_item = entry
+        self.current_image_path = entry['path']
+        self.current_post_url = entry['post_url']
+        self.current_image_url = entry['image_url']
+        self.update_status(f"Wallpaper set from your library. Source: {self.current_post_url or entry['path']}")
+        if self.on_wallpaper:
+            self.on_wallpaper(entry)
+        return True
+
+    @property
+    def paused(self):
+        return self.scheduler is not None and self.scheduler.paused
+
+    def wallpaper_loop(self):
+        if self.prefetcher.layout.is_spanned:
+            self.backend.set_style(WALLPAPER_STYLE_SPAN)
+        scheduler = self.scheduler
+        while scheduler.wait():
+            try:
+                due_at = time.perf_counter()
+                ready_item = self.prefetcher.get(until_offline=True)
+                if ready_item is None and self.prefetcher.offline:
+                    # Danbooru is unreachable, so keep rotating through what is already cached.
+                    ready_item = self.image_cache.next_offline(exclude={self.current_cache_key}, fit=self.prefetcher.layout.signature)
+                    if ready_item is not None:
+                        self.image_cache.pin(ready_item['key'])
+                        metrics.count('offline_replays')
+                    else:
+                        ready_item = self.prefetcher.get() # Nothing cached either; wait for the connection to come back
+                if ready_item is None:
+                    continue # Stopped
+                # How long the change was held up waiting for a wallpaper; about 0 while the queue keeps up.
+                metrics.observe('queue_wait', time.perf_counter() - due_at)
+                if not scheduler.hold():
+                    self.image_cache.unpin(ready_item['key'])
+                    break
+
+                # Everything below is local: the file is already in the cache, so only the backend call remains.
+                start_time = time.perf_counter()
+                if self.backend.set_wallpaper(ready_item['path']):
+                    elapsed_ms = (time.perf_counter() - start_time) * 1000
+                    metrics.observe('set_wallpaper', elapsed_ms / 1000)
+                    metrics.count('wallpapers_set')
+                    metrics.write_log({'event': 'wallpaper', 'key': ready_item['key'], 'set_ms': round(elapsed_ms, 1),
+                                       'downloaded_bytes': ready_item.get('downloaded_bytes', 0), 'queue_depth': self.prefetcher.depth()})
+                    if self.current_cache_key:
+                        self.image_cache.unpin(self.current_cache_key)
+                    self.current_cache_key = ready_item['key']
+                    self.image_cache.mark_shown(self.current_cache_key)
+                    self.current_item = ready_item
+                    self.history.add(ready_item.get('post_ids', []))
+                    self.current_image_path = ready_item['path']
+                    self.current_post_url = ready_item['post_url']
+                    self.current_image_url = ready_item['image_url']
+                    if self.prefetcher.offline:
+                        self.update_status(f"Offline: showing a cached wallpaper. Source: {self.current_post_url}")
+                    else:
+                        self.update_status(f"Wallpaper set in {elapsed_ms:.0f} ms (queue {self.prefetcher.depth()}/{self.prefetcher.queue_size}, pool {self.prefetcher.pool_size()}). Source: {self.current_post_url}")
+                    if self.on_wallpaper:
+                        self.on_wallpaper(ready_item)
+                    self.save_snapshot()
+                else:
+                    self.image_cache.unpin(ready_item['key'])
+                    metrics.count('set_wallpaper_errors')
+                    self.update_status(f"Error: Failed to set wallpaper via {self.backend.name}.")
+            except Exception as e:
+                self.update_status(f"An unexpected error occurred: {e}. Retrying...")
+                scheduler.retry_in(30)
@@ -0,0 +1,642 @@
+import tkinter as tk
+from tkinter import ttk, messagebox, font
+from PIL import Image, ImageTk
+import threading
+import os
+import sys
+import webbrowser
+from wallpaper_engine import (
+    APP_NAME, VERSION, RATINGS, DEFAULT_TAGS, DEFAULT_RATING, DEFAULT_INTERVAL, THUMBNAIL_SIZE,
+    MonitorLayout, PreviewCache, SlideshowEngine, ThumbnailCache, WallpaperLibrary, get_screen_size, load_snapshot, parse_playlist,
+)
+
+# --- Constants ---
+DONATION_URL = "coff.ee/XiaoInt"
+RATING_INFO_URL = "https://danbooru.donmai.us/wiki_pages/howto:rate"
+SCRIPT_PATH = os.path.abspath(sys.argv[0])
+ICON_PATH = "app_icon.ico"
+GALLERY_CELL_WIDTH = THUMBNAIL_SIZE[0] + 16
+GALLERY_CELL_HEIGHT = THUMBNAIL_SIZE[1] + 16
+
+def get_startup_script_path():
+    """Path of the script that launches the app at login; APPDATA is only looked up when it is needed."""
+    startup_folder = os.path.join(os.getenv('APPDATA', ''), 'Microsoft', 'Windows', 'Start Menu', 'Programs', 'Startup')
+    return os.path.join(startup_folder, f"{APP_NAME}.bat")
+
+
+# --- GUI Application ---
+class DanbooruWallpaperApp:
+    """The main class for the Tkinter GUI application."""
+    def __init__(self, root, engine=None):
+        self.root = root
+        self.root.title(f"{APP_NAME} v{VERSION}")
+        self.root.geometry("550x530") 
+        self.root.minsize(500, 500)
+
+        if os.path.exists(ICON_PATH):
+            self.root.iconbitmap(ICON_PATH)
+
+        # --- State & System Tray Variables ---
+        # The engine may already be running (--startup sets the first wallpaper before the GUI is built).
+        self.engine = engine or SlideshowEngine()
+        self.engine.on_status = self.update_status
+        self.engine.on_wallpaper = self.on_wallpaper_set
+        self.current_item = self.engine.current_item
+        self.current_image_path = self.engine.current_image_path
+        self.current_image_url = self.engine.current_image_url
+        self.current_post_url = self.engine.current_post_url
+        self.preview_cache = PreviewCache()
+        self.preview_size = (self.root.winfo_screenwidth(), self.root.winfo_screenheight())
+        self.screen_size = get_screen_size()
+        self.preview_window = None
+        self.library = WallpaperLibrary() # Creates the Pictures folder the library lives in
+        self.thumbnails = ThumbnailCache()
+        self.library_window = None
+        self.tray_icon = None
+        self.stop_thread = None # Runs engine.stop() after the Stop button
+
+        # --- Style Configuration ---
+        self.style = ttk.Style(self.root)
+        self.style.theme_use('clam')
+        self.style.configure("TLabel", padding=5, font=('Segoe UI', 10))
+        self.style.configure("TButton", padding=6, font=('Segoe UI', 10, 'bold'))
+        self.style.configure("TEntry", padding=5, font=('Segoe UI', 10))
+        self.style.configure("TFrame", padding=10)
+        self.style.configure("Header.TLabel", font=('Segoe UI', 14, 'bold'))
+        self.style.configure("Info.TButton", font=('Segoe UI', 8, 'bold'), padding=(2,0))
+        self.style.configure("Donate.TButton", font=('Segoe UI', 9, 'bold'), foreground='red')
+
+        self.create_widgets()
+
+        if self.engine.is_active():
+            self.sync_with_engine()
+        else:
+            # --- FIX: Check for a wallpaper from the last session on startup ---
+            self.check_for_existing_wallpaper()
+            threading.Thread(target=self.engine.image_cache.remove_stale_files, daemon=True).start()
+
+    def sync_with_engine(self):
+        """Reflects a slideshow that was started before the window existed."""
+        prefetcher = self.engine.prefetcher
+        self.tags_var.set(prefetcher.tags)
+        self.rating_var.set(prefetcher.rating)
+        self.interval_var.set(str(self.engine.interval))
+        self.align_var.set(self.engine.align)
+        self.crop_var.set(self.engine.crop)
+        if prefetcher.layout.is_spanned:
+            self.monitors_var.set(prefetcher.layout.signature.replace(',', ', '))
+        self.lock_settings()
+        self.start_button.config(state=tk.DISABLED)
+        self.stop_button.config(state=tk.NORMAL)
+        self.pause_button.config(state=tk.NORMAL, text="Resume" if self.engine.paused else "Pause")
+        self.next_button.config(state=tk.NORMAL)
+        if self.current_image_path:
+            self.on_wallpaper_set(None)
+
+    def check_for_existing_wallpaper(self):
+        """Picks up the last wallpaper from the image cache and enables buttons if found."""
+        cached_item = self.engine.image_cache.last_shown()
+        if cached_item:
+            self.current_item = cached_item
+            self.current_image_path = cached_item['path']
+            self.current_image_url = cached_item['image_url']
+            self.current_post_url = cached_item['post_url']
+            self.preview_cache.request(self.current_image_path, self.preview_size)
+            self.save_button.config(state=tk.NORMAL)
+            self.preview_button.config(state=tk.NORMAL)
+            self.update_status("Found wallpaper from last session. Ready to preview.")
+
+    def show_info(self):
+        """Displays an informational message box about tags, usage, and license."""
+        info_text = (
+            "--- How to Find and Use Tags ---\n\n"
+            "1. Finding Tags:\n"
+            "   - Go to the Danbooru website (danbooru.donmai.us).\n\n"
+            "2. Tag Formatting:\n"
+            "   - Separate multiple tags with spaces (e.g., 'genshin_impact 1girl').\n"
+            "   - For tags with multiple words, use underscores (_) (e.g., 'long_hair').\n\n"
+            "3. Playlists:\n"
+            "   - Separate several searches with '; ' to rotate between them (e.g., 'genshin_impact 1girl; scenery').\n"
+            "   - Only a ';' followed by a space separates searches, so tags like ';d' keep working.\n"
+            "   - Add 'weight:3' to show a search three times as often, or 'rating:sensitive' to give it its own rating.\n"
+            "   - Searches that keep finding nothing are skipped for a while automatically.\n\n"
+            "--- About & License ---\n\n"
+            "Disclaimer:\n"
+            "This application is a tool to access content from the Danbooru API for personal use. The images are the property of their respective copyright holders.\n\n"
+            "License (GNU GPLv3):\n"
+            "This is free software. You are free to use, study, share, and improve it. If you distribute modified versions, they must also be licensed under the GPLv3."
+        )
+        messagebox.showinfo("Info & About", info_text)
+        
+    def show_monitors_info(self):
+        """Explains the monitor layout format."""
+        info_text = (
+            "Leave this empty to use a single wallpaper for your main screen.\n\n"
+            "For several monitors, list each one as WIDTHxHEIGHT+X+Y, separated by commas, "
+            "using the positions shown in Windows display settings. For example:\n\n"
+            "   1920x1080+0+0, 2560x1440+1920+0\n\n"
+            "Each monitor gets its own image matching its shape, and they are combined into one spanned wallpaper.\n\n"
+            "Tick 'Crop to fit' to also use images of other shapes: each one is cropped to the most detailed part that fits the screen."
+        )
+        messagebox.showinfo("Monitor Layout", info_text)
+
+    def toggle_startup(self):
+        """Creates or deletes the startup script."""
+        startup_script_path = get_startup_script_path()
+        if self.startup_var.get():
+            executable_path = sys.executable if SCRIPT_PATH.endswith('.py') else SCRIPT_PATH
+            script_to_run = f'"{SCRIPT_PATH}"' if SCRIPT_PATH.endswith('.py') else ''
+            command = f'start "" "{executable_path}" {script_to_run} --startup'
+            
+            with open(startup_script_path, "w") as f:
+                f.write(command)
+        else:
+            if os.path.exists(startup_script_path):
+                os.remove(startup_script_path)
+
+    def create_widgets(self):
+        """Creates and arranges all the GUI widgets."""
+        main_frame = ttk.Frame(self.root, padding=(20, 10))
+        main_frame.pack(fill=tk.BOTH, expand=True)
+
+        header_label = ttk.Label(main_frame, text=APP_NAME, style="Header.TLabel")
+        header_label.pack(pady=(0, 15))
+
+        settings_frame = ttk.Frame(main_frame)
+        settings_frame.pack(fill=tk.X, expand=True)
+        settings_frame.columnconfigure(1, weight=1)
+
+        # Tags
+        tags_frame = ttk.Frame(settings_frame)
+        tags_frame.grid(row=0, column=0, columnspan=2, sticky="ew", padx=5, pady=5)
+        tags_frame.columnconfigure(1, weight=1)
+        ttk.Label(tags_frame, text="Tags:").grid(row=0, column=0, sticky="w")
+        self.info_button = ttk.Button(tags_frame, text="?", style="Info.TButton", width=2, command=self.show_info)
+        self.info_button.grid(row=0, column=2, sticky='e', padx=(5,0))
+        self.tags_var = tk.StringVar(value=DEFAULT_TAGS)
+        self.tags_entry = ttk.Entry(tags_frame, textvariable=self.tags_var)
+        self.tags_entry.grid(row=0, column=1, sticky="ew", padx=(5, 2))
+
+        # Rating
+        rating_frame = ttk.Frame(settings_frame)
+        rating_frame.grid(row=1, column=0, columnspan=2, sticky="ew", padx=5, pady=5)
+        rating_frame.columnconfigure(1, weight=1)
+        ttk.Label(rating_frame, text="Rating:").grid(row=0, column=0, sticky="w")
+        self.rating_info_button = ttk.Button(rating_frame, text="?", style="Info.TButton", width=2, command=lambda: webbrowser.open_new(RATING_INFO_URL))
+        self.rating_info_button.grid(row=0, column=2, sticky='e', padx=(5,0))
+        self.rating_var = tk.StringVar(value=DEFAULT_RATING)
+        self.rating_menu = ttk.OptionMenu(rating_frame, self.rating_var, DEFAULT_RATING, *RATINGS)
+        self.rating_menu.grid(row=0, column=1, sticky="ew", padx=(5, 2))
+
+        # Interval
+        interval_frame = ttk.Frame(settings_frame)
+        interval_frame.grid(row=2, column=0, columnspan=2, sticky="ew", padx=5, pady=5)
+        interval_frame.columnconfigure(1, weight=1)
+        ttk.Label(interval_frame, text="Interval (s):").grid(row=0, column=0, sticky="w")
+        self.interval_var = tk.StringVar(value=str(DEFAULT_INTERVAL))
+        self.interval_entry = ttk.Entry(interval_frame, textvariable=self.interval_var)
+        self.interval_entry.grid(row=0, column=1, sticky="ew")
+        # The interval can be changed while the slideshow runs; it applies on Enter or when leaving the field.
+        self.interval_entry.bind("<Return>", self.apply_interval)
+        self.interval_entry.bind("<FocusOut>", self.apply_interval)
+        self.align_var = tk.BooleanVar(value=False)
+        self.align_check = ttk.Checkbutton(interval_frame, text="Align to clock", variable=self.align_var)
+        self.align_check.grid(row=0, column=2, sticky="e", padx=(5, 0))
+
+        # Monitors (blank = a single screen at the detected resolution)
+        monitors_frame = ttk.Frame(settings_frame)
+        monitors_frame.grid(row=3, column=0, columnspan=2, sticky="ew", padx=5, pady=5)
+        monitors_frame.columnconfigure(1, weight=1)
+        ttk.Label(monitors_frame, text="Monitors:").grid(row=0, column=0, sticky="w")
+        self.monitors_info_button = ttk.Button(monitors_frame, text="?", style="Info.TButton", width=2, command=self.show_monitors_info)
+        self.monitors_info_button.grid(row=0, column=2, sticky='e', padx=(5,0))
+        self.monitors_var = tk.StringVar(value="")
+        self.monitors_entry = ttk.Entry(monitors_frame, textvariable=self.monitors_var)
+        self.monitors_entry.grid(row=0, column=1, sticky="ew", padx=(5, 2))
+        self.crop_var = tk.BooleanVar(value=False)
+        self.crop_check = ttk.Checkbutton(monitors_frame, text="Crop to fit", variable=self.crop_var)
+        self.crop_check.grid(row=0, column=3, sticky="e", padx=(5, 0))
+
+        # --- Start with Windows Checkbox ---
+        self.startup_var = tk.BooleanVar()
+        self.startup_check = ttk.Checkbutton(main_frame, text="Start with Windows", variable=self.startup_var, command=self.toggle_startup)
+        self.startup_check.pack(pady=10)
+        if os.path.exists(get_startup_script_path()):
+            self.startup_var.set(True)
+
+        # Controls
+        controls_frame = ttk.Frame(main_frame)
+        controls_frame.pack(fill=tk.X, pady=(5, 10))
+        controls_frame.columnconfigure((0, 1, 2), weight=1)
+        self.start_button = ttk.Button(controls_frame, text="Start Slideshow", command=self.start_slideshow)
+        self.start_button.grid(row=0, column=0, columnspan=3, sticky="ew", padx=5)
+        self.pause_button = ttk.Button(controls_frame, text="Pause", command=self.toggle_pause, state=tk.DISABLED)
+        self.pause_button.grid(row=1, column=0, sticky="ew", padx=5, pady=5)
+        self.next_button = ttk.Button(controls_frame, text="Next Wallpaper", command=self.next_wallpaper, state=tk.DISABLED)
+        self.next_button.grid(row=1, column=1, sticky="ew", padx=5, pady=5)
+        self.stop_button = ttk.Button(controls_frame, text="Stop", command=self.stop_slideshow, state=tk.DISABLED)
+        self.stop_button.grid(row=1, column=2, sticky="ew", padx=5, pady=5)
+
+        # Actions
+        actions_frame = ttk.Frame(main_frame)
+        actions_frame.pack(fill=tk.X, pady=(5, 10))
+        actions_frame.columnconfigure((0, 1, 2), weight=1)
+        self.save_button = ttk.Button(actions_frame, text="Save Current", command=self.save_wallpaper, state=tk.DISABLED)
+        self.save_button.grid(row=0, column=0, sticky="ew", padx=5)
+        self.preview_button = ttk.Button(actions_frame, text="Preview", command=self.toggle_preview, state=tk.DISABLED)
+        self.preview_button.grid(row=0, column=1, sticky="ew", padx=5)
+        self.library_button = ttk.Button(actions_frame, text="Library", command=self.show_library)
+        self.library_button.grid(row=0, column=2, sticky="ew", padx=5)
+
+        # --- Background info text ---
+        bg_info_label = ttk.Label(main_frame, text="You can close this window; the app will run in the background.", font=('Segoe UI', 8, 'italic'), justify=tk.CENTER)
+        bg_info_label.pack(pady=(5,0))
+
+        # Status Label
+        self.status_var = tk.StringVar(value="Ready. Click 'Start Slideshow' to begin.")
+        status_label = ttk.Label(main_frame, textvariable=self.status_var, wraplength=500, justify=tk.CENTER)
+        status_label.pack(fill=tk.X, pady=(5, 0))
+
+        # Footer
+        footer_frame = ttk.Frame(main_frame)
+        footer_frame.pack(side=tk.BOTTOM, fill=tk.X, anchor='s', pady=(5,0))
+        credit_font = font.Font(family='Segoe UI', size=8, underline=True)
+        credit_label = tk.Label(footer_frame, text="Created by xiaoint", fg="blue", cursor="hand2", font=credit_font)
+        credit_label.pack(side=tk.LEFT, padx=5)
+        credit_label.bind("<Button-1>", lambda e: webbrowser.open_new("https://github.com/xiaoint"))
+        donate_button = ttk.Button(footer_frame, text="❤ Donate", style="Donate.TButton", command=lambda: webbrowser.open_new(DONATION_URL))
+        donate_button.pack(side=tk.RIGHT, padx=5)
+
+    def lock_settings(self):
+        """Disables settings widgets while the slideshow is running."""
+        self.tags_entry.config(state=tk.DISABLED)
+        self.rating_menu.config(state=tk.DISABLED)
+        self.align_check.config(state=tk.DISABLED)
+        self.crop_check.config(state=tk.DISABLED)
+        self.monitors_entry.config(state=tk.DISABLED)
+        self.startup_check.config(state=tk.DISABLED)
+
+    def unlock_settings(self):
+        """Enables settings widgets when the slideshow is stopped."""
+        self.tags_entry.config(state=tk.NORMAL)
+        self.rating_menu.config(state=tk.NORMAL)
+        self.align_check.config(state=tk.NORMAL)
+        self.crop_check.config(state=tk.NORMAL)
+        self.monitors_entry.config(state=tk.NORMAL)
+        self.startup_check.config(state=tk.NORMAL)
+
+    def parse_interval(self):
+        """Returns the interval entered in seconds, or None if it is not a positive whole number."""
+        try:
+            interval = int(self.interval_var.get())
+        except ValueError:
+            return None
+        return interval if interval >= 1 else None
+
+    def apply_interval(self, event=None):
+        """Passes an edited interval on to a running slideshow; the pending change is rescheduled at once."""
+        if not self.engine.is_active() or self.interval_var.get() == str(self.engine.interval):
+            return
+        interval = self.parse_interval()
+        if interval is None:
+            # No message box here: it would steal focus and fire <FocusOut> again.
+            self.interval_var.set(str(self.engine.interval))
+            self.update_status(f"Invalid interval; keeping {self.engine.interval}s.")
+            return
+        self.engine.set_interval(interval)
+        self.update_status(f"Interval changed to {interval}s.")
+
+    def start_slideshow(self):
+        if self.engine.is_active():
+            return
+        try:
+            layout = MonitorLayout.parse(self.monitors_var.get(), self.screen_size)
+        except ValueError as e:
+            messagebox.showerror("Invalid Monitor Layout", str(e))
+            return
+        try:
+            parse_playlist(self.tags_var.get(), self.rating_var.get())
+        except ValueError as e:
+            messagebox.showerror("Invalid Playlist", str(e))
+            return
+        interval = self.parse_interval()
+        if interval is None:
+            messagebox.showerror("Invalid Interval", "The interval must be a whole number of seconds, at least 1.")
+            return
+        self.lock_settings() 
+        if self.stop_thread:
+            self.stop_thread.join() # An earlier Stop must have stopped the old loop, or start() would ignore us
+        self.engine.start(self.tags_var.get().strip(), self.rating_var.get(), interval, layout, self.align_var.get(), self.crop_var.get(), load_snapshot())
+        self.start_button.config(state=tk.DISABLED)
+        self.stop_button.config(state=tk.NORMAL)
+        self.pause_button.config(state=tk.NORMAL, text="Pause")
+        self.next_button.config(state=tk.NORMAL)
+        self.update_status("Slideshow started...")
+
+    def stop_slideshow(self):
+        self.unlock_settings() 
+        # Stopping writes the snapshot and history to disk, so keep it off the Tk thread.
+        self.stop_thread = threading.Thread(target=self.engine.stop, daemon=True)
+        self.stop_thread.start()
+        self.start_button.config(state=tk.NORMAL)
+        self.stop_button.config(state=tk.DISABLED)
+        self.pause_button.config(state=tk.DISABLED, text="Pause")
+        self.next_button.config(state=tk.DISABLED)
+        self.update_status("Slideshow stopped.")
+
+    def next_wallpaper(self, icon=None, item=None):
+        """Skips to the next wallpaper right away. Also used by the tray menu, hence the pystray arguments."""
+        if self.engine.is_active():
+            self.engine.skip()
+            self.update_status("Switching to the next wallpaper...")
+
+    def toggle_pause(self):
+        if not self.engine.paused:
+            self.engine.pause()
+            self.pause_button.config(text="Resume")
+            self.update_status("Paused. Waiting for resume...")
+        else:
+            self.engine.resume()
+            self.pause_button.config(text="Pause")
+            self.update_status(f"Resumed. Next wallpaper in {self.engine.scheduler.seconds_until_next():.0f}s.")
+
+    def save_wallpaper(self):
+        """Adds the current wallpaper to the library. The tag lookup runs in the background, so the window never waits on it."""
+        item = self.current_item
+        if not item or not os.path.exists(item['path']):
+            messagebox.showerror("Error", "No valid wallpaper to save.")
+            return
+        self.save_button.config(state=tk.DISABLED)
+        threading.Thread(target=self._save_to_library, args=(item,), daemon=True).start()
+
+    def _save_to_library(self, item):
+        try:
+            entry, created = self.library.save(item, self.engine.http_client)
+        except Exception as e:
+            self.root.after(0, self.on_save_failed, e)
+        else:
+            self.root.after(0, self.on_saved, entry, created)
+
+    def on_saved(self, entry, created):
+        self.save_button.config(state=tk.NORMAL)
+        if self.library_window and self.library_window.exists():
+            self.library_window.refresh()
+        if created:
+            messagebox.showinfo("Success", f"Wallpaper saved to:\n{os.path.abspath(entry['path'])}")
+        else:
+            messagebox.showinfo("Already Saved", f"This wallpaper is already in your library:\n{os.path.abspath(entry['path'])}")
+
+    def on_save_failed(self, error):
+        self.save_button.config(state=tk.NORMAL)
+        messagebox.showerror("Save Failed", f"Could not save the wallpaper: {error}")
+
+    def show_library(self):
+        """Opens the gallery of saved wallpapers, or brings it to the front if it is already open."""
+        if self.library_window and self.library_window.exists():
+            self.library_window.window.lift()
+            return
+        self.library_window = LibraryWindow(self)
+
+    def update_status(self, message):
+        self.root.after(0, self.status_var.set, message)
+
+    def on_wallpaper_set(self, item):
+        """Called by the engine after each change; picks up the new wallpaper for saving and previews."""
+        self.current_item = self.engine.current_item
+        self.current_image_path = self.engine.current_image_path
+        self.current_image_url = self.engine.current_image_url
+        self.current_post_url = self.engine.current_post_url
+        self.preview_cache.request(self.current_image_path, self.preview_size)
+        # --- FIX: Enable both save and preview buttons ---
+        self.root.after(0, lambda: self.save_button.config(state=tk.NORMAL))
+        self.root.after(0, lambda: self.preview_button.config(state=tk.NORMAL))
+
+    def show_notification(self, title, message):
+        """Shows a Windows notification using winotify."""
+        def _show():
+            from winotify import Notification, audio
+            toast = Notification(app_id=APP_NAME,
+                                 title=title,
+                                 msg=message,
+                                 duration='short')
+            toast.set_audio(audio.Default, loop=False)
+            if os.path.exists(ICON_PATH):
+                toast.set_icon(os.path.abspath(ICON_PATH))
+            toast.show()
+        threading.Thread(target=_show, daemon=True).start()
+
+    def hide_window(self):
+        """Hides the main window and creates a system tray icon."""
+        from pystray import MenuItem as item, Icon
+        self.root.withdraw()
+        if os.path.exists(ICON_PATH):
+            image = Image.open(ICON_PATH)
+        else:
+            image = Image.new('RGB', (64, 64), 'black') # Placeholder icon
+            
+        menu = (item('Show', self.show_window), item('Next Wallpaper', self.next_wallpaper), item('Quit', self.quit_app))
+        self.tray_icon = Icon("name", image, f"{APP_NAME}", menu)
+        
+        self.show_notification(f"{APP_NAME}", "Running in the background.")
+        
+        threading.Thread(target=self.tray_icon.run, daemon=True).start()
+
+    def show_window(self, icon, item):
+        """Shows the main window and stops the tray icon."""
+        self.tray_icon.stop()
+        self.root.after(0, self.root.deiconify)
+
+    def quit_app(self, icon=None, item=None):
+        """Properly quits the application from the system tray."""
+        if self.tray_icon:
+            self.tray_icon.stop()
+        if self.stop_thread:
+            self.stop_thread.join() # Let an earlier Stop finish saving before the process exits
+        self.engine.stop(timeout=2)
+        # --- FIX: Do not delete any temp files on quit, so they can be previewed next time ---
+        self.root.destroy()
+
+    def toggle_preview(self):
+        """Toggles a fullscreen preview of the current wallpaper."""
+        if self.preview_window and self.preview_window.winfo_exists():
+            self.preview_window.destroy()
+            self.preview_window = None
+            return
+
+        if not self.current_image_path or not os.path.exists(self.current_image_path):
+            messagebox.showinfo("No Preview", "No wallpaper has been set in this session yet.")
+            return
+
+        # Previews are decoded in the background; if this one is not ready yet, open it once it is.
+        img = self.preview_cache.get(self.current_image_path, self.preview_size)
+        if img is None:
+            self.preview_button.config(text="Loading...", state=tk.DISABLED)
+            self.preview_cache.request(self.current_image_path, self.preview_size, lambda img: self.root.after(0, self.on_preview_ready, img))
+            return
+        self.show_preview(img)
+
+    def on_preview_ready(self, img):
+        """Restores the preview button and opens the preview that was requested while it was loading."""
+        self.preview_button.config(text="Preview", state=tk.NORMAL)
+        if img is None:
+            messagebox.showerror("Preview Failed", "Could not load the wallpaper preview.")
+            return
+        self.show_preview(img)
+
+    def show_preview(self, img):
+        """Opens the fullscreen preview window for an already decoded image."""
+        self.preview_window = tk.Toplevel(self.root)
+        self.preview_window.title("Wallpaper Preview - Press ESC to close")
+        self.preview_window.configure(bg='black')
+        self.preview_window.attributes('-fullscreen', True)
+        
+        photo = ImageTk.PhotoImage(img)
+        
+        label = tk.Label(self.preview_window, image=photo, bg='black')
+        label.image = photo # Keep a reference!
+        label.pack(expand=True)
+        
+        self.preview_window.bind("<Escape>", lambda e: self.preview_window.destroy())
+
+
+# --- Library Gallery ---
+class LibraryWindow:
+    """Gallery of saved wallpapers. Only the rows in view are drawn and only their thumbnails are decoded,
+    so it opens and scrolls the same with a few images or tens of thousands."""
+    def __init__(self, app):
+        self.app = app
+        self.library = app.library
+        self.thumbnails = app.thumbnails
+        self.window = tk.Toplevel(app.root)
+        self.window.title(f"{APP_NAME} - Library")
+        self.window.geometry("900x600")
+        self.window.minsize(GALLERY_CELL_WIDTH + 40, GALLERY_CELL_HEIGHT + 80)
+        self.count = 0
+        self.columns = 1
+        self.selected = None
+        self.photos = {} # key -> PhotoImage for the cells in view; Tk needs a reference to keep showing them
+        self.redraw_pending = False
+
+        toolbar = ttk.Frame(self.window, padding=(10, 5))
+        toolbar.pack(fill=tk.X)
+        self.count_var = tk.StringVar()
+        ttk.Label(toolbar, textvariable=self.count_var).pack(side=tk.LEFT)
+        self.source_button = ttk.Button(toolbar, text="Open Source", command=self.open_source, state=tk.DISABLED)
+        self.source_button.pack(side=tk.RIGHT, padx=5)
+        self.set_button = ttk.Button(toolbar, text="Set as Wallpaper", command=self.set_wallpaper, state=tk.DISABLED)
+        self.set_button.pack(side=tk.RIGHT, padx=5)
+
+        grid_frame = ttk.Frame(self.window, padding=0)
+        grid_frame.pack(fill=tk.BOTH, expand=True)
+        self.canvas = tk.Canvas(grid_frame, bg='#202020', highlightthickness=0)
+        scrollbar = ttk.Scrollbar(grid_frame, orient=tk.VERTICAL, command=self.canvas.yview)
+        self.canvas.configure(yscrollcommand=lambda first, last: (scrollbar.set(first, last), self.schedule_redraw()))
+        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        self.canvas.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+
+        self.canvas.bind("<Configure>", lambda e: self.relayout())
+        self.canvas.bind("<Button-1>", self.on_click)
+        self.canvas.bind("<Double-Button-1>", self.on_double_click)
+        self.canvas.bind("<MouseWheel>", lambda e: self.canvas.yview_scroll(-1 if e.delta > 0 else 1, 'units'))
+        self.canvas.bind("<Button-4>", lambda e: self.canvas.yview_scroll(-1, 'units'))
+        self.canvas.bind("<Button-5>", lambda e: self.canvas.yview_scroll(1, 'units'))
+        self.window.bind("<Escape>", lambda e: self.window.destroy())
+        self.refresh()
+
+    def exists(self):
+        return self.window.winfo_exists()
+
+    def refresh(self):
+        """Re-reads the number of saved wallpapers, e.g. after a save."""
+        self.count = self.library.count()
+        self.count_var.set(f"{self.count} saved wallpaper{'s' if self.count != 1 else ''}. Double-click one to set it.")
+        self.relayout()
+
+    def relayout(self):
+        self.columns = max(1, self.canvas.winfo_width() // GALLERY_CELL_WIDTH)
+        rows = -(-self.count // self.columns)
+        self.canvas.configure(scrollregion=(0, 0, self.columns * GALLERY_CELL_WIDTH, rows * GALLERY_CELL_HEIGHT),
+                              yscrollincrement=GALLERY_CELL_HEIGHT // 4)
+        self.schedule_redraw()
+
+    def schedule_redraw(self):
+        # Scrolling fires many view changes per frame; draw once they have settled.
+        if not self.redraw_pending:
+            self.redraw_pending = True
+            self.window.after_idle(self.redraw)
+
+    def redraw(self):
+        self.redraw_pending = False
+        if not self.exists():
+            return
+        top = self.canvas.canvasy(0)
+        first_row = int(top // GALLERY_CELL_HEIGHT)
+        last_row = int((top + self.canvas.winfo_height()) // GALLERY_CELL_HEIGHT)
+        first_index = first_row * self.columns
+        entries = self.library.page(first_index, (last_row - first_row + 1) * self.columns)
+
+        self.canvas.delete('cell')
+        visible = set()
+        for index, entry in enumerate(entries, first_index):
+            row, column = divmod(index, self.columns)
+            x = column * GALLERY_CELL_WIDTH + GALLERY_CELL_WIDTH // 2
+            y = row * GALLERY_CELL_HEIGHT + GALLERY_CELL_HEIGHT // 2
+            key = entry['key']
+            visible.add(key)
+            if self.selected and self.selected['key'] == key:
+                self.canvas.create_rectangle(x - GALLERY_CELL_WIDTH // 2 + 2, y - GALLERY_CELL_HEIGHT // 2 + 2,
+                                             x + GALLERY_CELL_WIDTH // 2 - 2, y + GALLERY_CELL_HEIGHT // 2 - 2,
+                                             outline='#4a90d9', width=3, tags='cell')
+            photo = self.photo_for(entry)
+            if photo:
+                self.canvas.create_image(x, y, image=photo, tags='cell')
+            else:
+                width, height = THUMBNAIL_SIZE
+                self.canvas.create_rectangle(x - width // 2, y - height // 2, x + width // 2, y + height // 2,
+                                             fill='#303030', outline='', tags='cell')
+        # Forget what scrolled out of view: its photos and any thumbnails still waiting to be rendered.
+        self.photos = {key: photo for key, photo in self.photos.items() if key in visible}
+        self.thumbnails.retain(visible)
+
+    def photo_for(self, entry):
+        """Returns the thumbnail as a PhotoImage, or None after asking for it to be rendered."""
+        photo = self.photos.get(entry['key'])
+        if photo is None:
+            img = self.thumbnails.get(entry['key'])
+            if img is None:
+                self.thumbnails.request(entry['key'], entry['path'], lambda img: self.app.root.after(0, self.on_thumbnail_ready))
+                return None
+            photo = self.photos[entry['key']] = ImageTk.PhotoImage(img)
+        return photo
+
+    def on_thumbnail_ready(self):
+        if self.exists():
+            self.schedule_redraw()
+
+    def on_click(self, event):
+        column = int(self.canvas.canvasx(event.x) // GALLERY_CELL_WIDTH)
+        index = int(self.canvas.canvasy(event.y) // GALLERY_CELL_HEIGHT) * self.columns + column
+        entries = self.library.page(index, 1) if column < self.columns and index < self.count else []
+        self.selected = entries[0] if entries else None
+        state = tk.NORMAL if self.selected else tk.DISABLED
+        self.set_button.config(state=state)
+        self.source_button.config(state=tk.NORMAL if self.selected and self.selected['post_url'] else tk.DISABLED)
+        self.schedule_redraw()
+
+    def on_double_click(self, event):
+        self.on_click(event)
+        self.set_wallpaper()
+
+    def set_wallpaper(self):
+        """Applies the selected wallpaper from its local file; the backend call runs off the Tk thread."""
+        entry = self.selected
+        if not entry:
+            return
+        if not os.path.exists(entry['path']):
+            messagebox.showerror("Missing File", f"The file is no longer in your library folder:\n{entry['path']}", parent=self.window)
+            return
+        threading.Thread(target=self.app.engine.show_saved, args=(entry,), daemon=True).start()
+
+    def open_source(self):
+        if self.selected and self.selected['post_url']:
+            webbrowser.open_new(self.selected['post_url'])